@@ -1,6 +1,29 @@
+import logging
 from django.apps import AppConfig
+from django.conf import settings
+from django.db import DatabaseError
+
+logger = logging.getLogger(__name__)
 
 
 class DjangoDocumentPdfConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'django_document_pdf'
+
+    def ready(self):
+        # Invalidates the compiled layout plans when a spec changes.
+        from . import signals  # noqa: F401
+
+        bundles = getattr(settings, 'DOCUMENT_PDF_SPEC_BUNDLES', None)
+        if bundles:
+            # Specs compiled from the bundles, without the database.
+            from .bundles import load_bundles
+            load_bundles(bundles)
+
+        if getattr(settings, 'DOCUMENT_PDF_WARM_FONTS', False):
+            from .fonts import warm_fonts
+            try:
+                warm_fonts()
+            except DatabaseError as e:
+                # e.g. running migrate before the tables exist
+                logger.warning("Fonts not warmed: %s", e)
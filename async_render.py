@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+from django.db.models import Model
+from .document_wrapper import DocumentPDF
+from .layout import get_layout_plan
+from .parallel import RenderProcessPool, _render_chunk
+from .relations import prepare_queryset
+
+
+class RenderQueueFull(Exception):
+    """Raised when too many renders are already waiting, the caller should retry later."""
+
+
+class RenderLimiter:
+    """Bounds the renders running at once and the ones waiting for a slot.
+
+    Beyond max_waiting new renders are rejected with RenderQueueFull instead of
+    queueing, so a burst of documents can't take every worker of the server.
+    """
+
+    def __init__(self, max_concurrent, max_waiting):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.running = 0
+        self.waiting = 0
+        # asyncio primitives belong to one event loop, a semaphore per loop.
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphores[loop]
+
+    async def __aenter__(self):
+        if self.running >= self.max_concurrent and self.waiting >= self.max_waiting:
+            raise RenderQueueFull(f"{self.waiting} documents are already waiting to be rendered")
+        self.waiting += 1
+        try:
+            await self._semaphore().acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.running -= 1
+        self._semaphore().release()
+
+
+_executor = None
+_limiter = None
+_lock = threading.Lock()
+
+
+def get_render_executor():
+    """Thread pool of the async renders, DOCUMENT_PDF_ASYNC_WORKERS threads (default 4)."""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'DOCUMENT_PDF_ASYNC_WORKERS', 4),
+                thread_name_prefix='document_pdf')
+    return _executor
+
+
+def get_render_limiter():
+    """Limiter of the async renders, as many running as workers and
+    DOCUMENT_PDF_ASYNC_QUEUE (default 16) waiting."""
+    global _limiter
+    with _lock:
+        if _limiter is None:
+            _limiter = RenderLimiter(getattr(settings, 'DOCUMENT_PDF_ASYNC_WORKERS', 4),
+                                     getattr(settings, 'DOCUMENT_PDF_ASYNC_QUEUE', 16))
+    return _limiter
+
+
+def _render(document_class, document_spec_code, record):
+    try:
+        return document_class(document_spec_code, None, record).getPDFData()
+    finally:
+        # Lazy lookups the prefetch didn't cover may have opened a connection in this thread.
+        connections.close_all()
+
+
+async def agenerate_pdf(document_spec_code, model, pk, executor=None, limiter=None,
+                        document_class=DocumentPDF):
+    """Renders the spec for the record `pk` of `model` (a model or "app_label.ModelName")
+    and returns the PDF bytes without blocking the event loop.
+
+    The record and its relations are fetched with the async ORM, with the lookups
+    planned from the spec fields. Drawing runs in `executor` (default: the thread pool
+    of get_render_executor), a pool of parallel.get_process_executor renders from the
+    pk in a worker process instead, other process pools raise ValueError. Raises
+    RenderQueueFull when the limiter has too many renders waiting, and
+    model.DoesNotExist / DocumentSpec.DoesNotExist.
+    """
+    model = model if isinstance(model, type) and issubclass(model, Model) else apps.get_model(model)
+    limiter = limiter or get_render_limiter()
+    executor = executor or get_render_executor()
+    loop = asyncio.get_running_loop()
+    async with limiter:
+        plan = await sync_to_async(get_layout_plan)(document_spec_code)
+        if isinstance(executor, ProcessPoolExecutor):
+            if not isinstance(executor, RenderProcessPool):
+                # Its workers would lack Django or share the database sockets of this process.
+                raise ValueError("Process pools must be built by parallel.get_process_executor")
+            pdf, = await loop.run_in_executor(executor, _render_chunk, document_spec_code,
+                                              model._meta.label, None, [pk], document_class)
+            if pdf is None:
+                raise model.DoesNotExist(f"{model._meta.object_name} {pk} does not exist")
+            return pdf
+        record = await prepare_queryset(plan, model._default_manager.all()).aget(pk=pk)
+        return await loop.run_in_executor(executor, _render, document_class,
+                                          document_spec_code, record)
+
+
+async def astream_pdf(pdf, chunk_size=64 * 1024):
+    """Async iterator over chunks of rendered PDF bytes, for a StreamingHttpResponse."""
+    data = memoryview(pdf)
+    for idx in range(0, len(data), chunk_size):
+        yield data[idx:idx + chunk_size]
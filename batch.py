@@ -0,0 +1,81 @@
+import logging
+import time
+from itertools import islice
+from django.db.models import QuerySet
+from .document_wrapper import DocumentPDF
+from .layout import get_layout_plan
+from .relations import prefetch_records, prepare_queryset
+
+logger = logging.getLogger(__name__)
+
+
+class BatchResult:
+    """Summary of a batch run, `outputs` holds the written filenames (or the combined output)."""
+
+    def __init__(self, documents, seconds, outputs):
+        self.documents = documents
+        self.seconds = seconds
+        self.outputs = outputs
+
+    @property
+    def docs_per_sec(self):
+        return self.documents / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return f"{self.documents} documents in {self.seconds:.2f}s ({self.docs_per_sec:.1f} docs/sec)"
+
+
+def prefetch_details(records, plan, chunk_size=500):
+    """Yields the records with the relations read by the plan fields prefetched,
+    chunk_size records per query."""
+    if isinstance(records, QuerySet):
+        yield from prepare_queryset(plan, records).iterator(chunk_size=chunk_size)
+        return
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield from prefetch_records(plan, chunk)
+
+
+def render_batch(spec_code, records, output, combine=True, chunk_size=500,
+                 document_class=DocumentPDF, relation_cache=None):
+    """Renders the spec for every record reusing one compiled layout plan.
+
+    With combine=True every document is appended to a single PDF written to
+    `output`, a filename or a writable buffer. Otherwise a PDF is written per
+    record, `output` is then a format string such as "invoices/{pk}.pdf" or a
+    callable that receives the record and returns its filename.
+    relation_cache, e.g. RelationCache(max_size=1000), is shared by all the
+    documents instead of one cache per document.
+
+    Returns a BatchResult, the throughput is also logged.
+    """
+    plan = get_layout_plan(spec_code)
+    start = time.perf_counter()
+    outputs = []
+    curCanvas = None
+    count = 0
+    for record in prefetch_details(records, plan, chunk_size):
+        if combine:
+            doc = document_class(spec_code, output, record, relation_cache)
+            if curCanvas is None:
+                curCanvas = doc.createCanvas(output)
+            doc.generatePDF(curCanvas=curCanvas)
+        else:
+            filename = output(record) if callable(output) else output.format(
+                pk=record.pk, record=record)
+            document_class(spec_code, filename, record, relation_cache).generatePDF()
+            outputs.append(filename)
+        count += 1
+    if combine and curCanvas is not None:
+        curCanvas.save()
+        outputs.append(output)
+
+    result = BatchResult(count, time.perf_counter() - start, outputs)
+    logger.info("render_batch %s: %s", spec_code, result)
+    if relation_cache is not None:
+        logger.info("render_batch %s: relation cache %s hits, %s misses", spec_code,
+                    relation_cache.hits, relation_cache.misses)
+    return result
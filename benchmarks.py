@@ -0,0 +1,293 @@
+"""Rendering benchmarks for DocumentPDF.
+
+Runs against an in-memory SQLite database with synthetic specs and records,
+it never touches the project settings or database:
+
+    python -m django_document_pdf.benchmarks --output results.json
+    python -m django_document_pdf.benchmarks --compare results.json
+
+Each scenario reports per document latency, docs/sec, DB queries per
+document, peak traced memory, output size and bytes per page (of the file
+and of the uncompressed page content streams) as JSON, `--compare` exits
+with status 1 when a metric regressed beyond `--threshold`. The `wrapping`
+entry times the text wrappers alone.
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from django.conf import settings
+
+# name: (header fields, detail columns, detail rows, rows per page, labels, rects, images)
+SCENARIOS = {
+    'header_only': (10, 0, 0, None, 5, 3, 1),
+    'detail_50': (5, 6, 50, 25, 10, 5, 1),
+    'detail_500': (5, 6, 500, 50, 10, 5, 1),
+    'wide': (40, 10, 20, 20, 40, 20, 2),
+}
+
+# Metrics where a higher value is a regression, docs_per_sec is the opposite.
+LOWER_IS_BETTER = ('latency_ms_mean', 'latency_ms_p95', 'queries_per_doc',
+                   'peak_memory_kb', 'output_bytes', 'bytes_per_page',
+                   'content_bytes_per_page')
+
+
+def setup_django(media_dir):
+    settings.configure(
+        INSTALLED_APPS=['django.contrib.contenttypes', 'django_document_pdf'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        MIGRATION_MODULES={'django_document_pdf': None},
+        MEDIA_ROOT=media_dir,
+        USE_TZ=True,
+    )
+    import django
+    django.setup()
+
+
+def define_models():
+    from django.db import models
+
+    class BenchInvoice(models.Model):
+        Number = models.CharField(max_length=20)
+        Customer = models.CharField(max_length=100)
+        Total = models.DecimalField(max_digits=12, decimal_places=2)
+
+        class Meta:
+            app_label = 'django_document_pdf'
+
+    class BenchInvoiceLine(models.Model):
+        Invoice = models.ForeignKey(BenchInvoice, on_delete=models.CASCADE)
+        Description = models.CharField(max_length=100)
+        Quantity = models.IntegerField()
+        Price = models.DecimalField(max_digits=12, decimal_places=2)
+
+        class Meta:
+            app_label = 'django_document_pdf'
+
+    return BenchInvoice, BenchInvoiceLine
+
+
+def create_media(media_dir):
+    import reportlab
+    from PIL import Image
+    os.makedirs(os.path.join(media_dir, 'fonts'))
+    os.makedirs(os.path.join(media_dir, 'images'))
+    shutil.copy(os.path.join(os.path.dirname(reportlab.__file__), 'fonts', 'Vera.ttf'),
+                os.path.join(media_dir, 'fonts'))
+    image = Image.new('RGB', (400, 200))
+    image.putdata([(x % 256, (x // 400) % 256, 128) for x in range(400 * 200)])
+    image.save(os.path.join(media_dir, 'images', 'logo.png'))
+
+
+def create_spec(code, header, columns, rows_per_page, labels, rects, images):
+    from .models import (PDFFont, FontStyle, DocumentSpec, DocumentSpecFields,
+                         DocumentSpecLabels, DocumentSpecRects, DocumentSpecImages,
+                         DocumentSpecFonts)
+    font, _ = PDFFont.objects.get_or_create(Code='Vera', Font='fonts/Vera.ttf')
+    styles = [FontStyle.objects.get_or_create(
+        Code=f'bench{size}', PDFFont=font, Size=size, Color='#223344')[0] for size in (8, 10, 12)]
+    spec = DocumentSpec.objects.create(Code=code, Width=595, Height=842,
+                                       RowsPerPage=rows_per_page)
+    DocumentSpecFonts.objects.create(DocumentSpec=spec, PDFFont=font)
+    header_paths = ['Number', 'Customer', 'Total']
+    for idx in range(header):
+        DocumentSpecFields.objects.create(
+            DocumentSpec=spec, Field=header_paths[idx % 3], Style=styles[idx % 3], Type=0,
+            X=20 + (idx % 4) * 140, Y=40 + (idx // 4) * 14)
+    detail_paths = ['Description', 'Quantity', 'Price']
+    for idx in range(columns):
+        DocumentSpecFields.objects.create(
+            DocumentSpec=spec, Field=f'BenchInvoiceLine.{detail_paths[idx % 3]}',
+            Style=styles[0], Type=1, X=20 + idx * 55, Y=260, Width=50, Alignment=idx % 3,
+            TextLimit=40)
+    for idx in range(labels):
+        DocumentSpecLabels.objects.create(
+            DocumentSpec=spec, Text=f'Label {idx}', Style=styles[idx % 3],
+            X=20 + (idx % 4) * 140, Y=120 + (idx // 4) * 12, Alignment=0)
+    for idx in range(rects):
+        DocumentSpecRects.objects.create(
+            DocumentSpec=spec, X=10 + idx * 5, Y=10 + idx * 5, Width=200, Height=30,
+            Rounded=bool(idx % 2), Radius=4, Fill=bool(idx % 2), FillColor='blue',
+            FillColorAlpha=30)
+    for idx in range(images):
+        DocumentSpecImages.objects.create(
+            DocumentSpec=spec, X=380, Y=20 + idx * 110, Width=200, Height=100,
+            Filename='images/logo.png')
+    return spec
+
+
+def create_record(invoice_model, line_model, rows):
+    invoice = invoice_model.objects.create(Number='F-0001', Customer='ACME S.A.', Total=rows * 10)
+    line_model.objects.bulk_create(
+        line_model(Invoice=invoice, Description=f'Product number {idx} of the catalog',
+                   Quantity=idx % 7 + 1, Price=idx * 1.5)
+        for idx in range(rows))
+    return invoice
+
+
+def render(spec_code, record):
+    from .document_wrapper import DocumentPDF
+    return DocumentPDF(spec_code, None, record).getPDFData()
+
+
+def content_bytes(spec_code, record):
+    """Size of the page content streams of the document without compression, the
+    drawing operators alone without fonts, images and forms."""
+    from reportlab.pdfgen import canvas
+    from .document_wrapper import DocumentPDF
+    curCanvas = canvas.Canvas(None, pageCompression=0)
+    DocumentPDF(spec_code, None, record).generatePDF(curCanvas=curCanvas)
+    # Page contents are the only streams without a filter, subtype or font lengths.
+    return sum(int(length) for length in
+               re.findall(rb'<<\s*/Length (\d+)\s*>>\s*stream', curCanvas.getpdfdata()))
+
+
+def run_scenario(name, params, invoice_model, line_model, repeat):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    header, columns, rows, rows_per_page, labels, rects, images = params
+    create_spec(name, header, columns, rows_per_page, labels, rects, images)
+    record = create_record(invoice_model, line_model, rows)
+    # Warm up the plan, fonts and images caches like a long running worker.
+    data = render(name, record)
+
+    timings = []
+    with CaptureQueriesContext(connection) as queries:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            render(name, record)
+            timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    render(name, record)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    pages = data.count(b'/Type /Page\n')
+    return {
+        'params': dict(zip(('header_fields', 'detail_columns', 'detail_rows', 'rows_per_page',
+                            'labels', 'rects', 'images'), params)),
+        'latency_ms_mean': statistics.mean(timings) * 1000,
+        'latency_ms_p95': (statistics.quantiles(timings, n=20)[-1] if len(timings) > 1
+                           else timings[0]) * 1000,
+        'docs_per_sec': len(timings) / sum(timings),
+        'queries_per_doc': len(queries) / repeat,
+        'peak_memory_kb': peak / 1024,
+        'output_bytes': len(data),
+        'pages': pages,
+        'bytes_per_page': len(data) / pages,
+        'content_bytes_per_page': content_bytes(name, record) / pages,
+    }
+
+
+def run_wrapping(repeat):
+    """Micro-benchmark of the character count wrapper against the width based one,
+    in microseconds per text, over descriptions that repeat like invoice items."""
+    from .fonts import register_font
+    from .text_utils import string_width, wrapText, wrap_text_width
+    register_font('BenchVera', 'media/fonts/Vera.ttf')
+    texts = [f'Product number {idx % 50} of the catalog, stainless steel box of units'
+             for idx in range(1000)]
+
+    def per_text(wrap, passes):
+        start = time.perf_counter()
+        for _ in range(passes):
+            for text in texts:
+                wrap(text)
+        return (time.perf_counter() - start) / (passes * len(texts)) * 1e6
+
+    string_width.cache_clear()
+    width_cold = per_text(lambda text: wrap_text_width(text, 'BenchVera', 8, 150), 1)
+    return {
+        'char_count_us': per_text(lambda text: wrapText(text, 40), repeat),
+        'width_cold_us': width_cold,
+        'width_us': per_text(lambda text: wrap_text_width(text, 'BenchVera', 8, 150), repeat),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Returns the list of metrics that regressed more than threshold (a ratio)."""
+    regressions = []
+    for name, metrics in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        for metric, value in metrics.items():
+            old = previous.get(metric)
+            if not isinstance(value, (int, float)) or not old:
+                continue
+            change = (value - old) / old
+            if metric == 'docs_per_sec':
+                change = -change
+            elif metric not in LOWER_IS_BETTER:
+                continue
+            if change > threshold:
+                regressions.append(f"{name}.{metric}: {old:.2f} -> {value:.2f} ({change:+.0%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="Scenario to run, all of them by default.")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', help="Write the JSON results to this file.")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare with.")
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        media_dir = os.path.join(workdir, 'media')
+        create_media(media_dir)
+        # Fonts and images are read from the relative `media/` path.
+        os.chdir(workdir)
+        setup_django(media_dir)
+        invoice_model, line_model = define_models()
+        from django.core.management import call_command
+        call_command('migrate', run_syncdb=True, verbosity=0)
+
+        import django
+        import reportlab
+        results = {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'reportlab': reportlab.Version,
+            'repeat': args.repeat,
+            'scenarios': {},
+        }
+        for name in args.scenario or SCENARIOS:
+            results['scenarios'][name] = run_scenario(
+                name, SCENARIOS[name], invoice_model, line_model, args.repeat)
+        results['wrapping'] = run_wrapping(args.repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
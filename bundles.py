@@ -0,0 +1,242 @@
+import json
+import os
+from decimal import Decimal
+from types import SimpleNamespace
+from django.db import transaction
+from .layout import SpecSource, invalidate_layout_plan, register_spec_source
+from .models import (PDFFont, FontStyle, DocumentSpec, DocumentSpecFields, DocumentSpecLabels,
+                     DocumentSpecRects, DocumentSpecImages, DocumentSpecFonts)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+BUNDLE_FORMAT = 'django_document_pdf.specs'
+BUNDLE_VERSION = 1
+BUNDLE_EXTENSIONS = ('.json', '.msgpack')
+
+# Columns of the tables of a bundle, each row is a list of values in this order.
+# The columns are written in the bundle, so bundles of older versions stay readable.
+COLUMNS = {
+    'fonts': ('Code', 'Font'),
+    'styles': ('Code', 'PDFFont', 'Color', 'Size', 'Bold'),
+    'spec': ('Code', 'Width', 'Height', 'ScreenDpi', 'RowsPerPage', 'ShowPlaceHolder',
+             'PageCompression', 'Invariant', 'OutputStats', 'SizeBudget'),
+    'fields': ('Field', 'Style', 'Type', 'Width', 'Y', 'X', 'Decimals', 'Alignment',
+               'TextLimit'),
+    'labels': ('Text', 'Style', 'Y', 'X', 'Alignment'),
+    'rects': ('Height', 'Width', 'Y', 'X', 'Rounded', 'Radius', 'Stroke', 'StrokeColor',
+              'StrokeColorAlpha', 'Fill', 'FillColor', 'FillColorAlpha', 'Show'),
+    'images': ('Height', 'Width', 'Y', 'X', 'Filename', 'Watermark', 'WatermarkOpacity'),
+}
+MODELS = {
+    'fonts': PDFFont, 'styles': FontStyle, 'spec': DocumentSpec, 'fields': DocumentSpecFields,
+    'labels': DocumentSpecLabels, 'rects': DocumentSpecRects, 'images': DocumentSpecImages,
+}
+DETAILS = ('fields', 'labels', 'rects', 'images')
+
+
+def _value(obj, column):
+    value = getattr(obj, column)
+    if isinstance(value, (PDFFont, FontStyle)):
+        return value.Code
+    if isinstance(value, Decimal):
+        return str(value)
+    if hasattr(value, 'name'):  # FieldFile
+        return value.name
+    return value
+
+
+def _row(obj, table):
+    return [_value(obj, column) for column in COLUMNS[table]]
+
+
+def export_specs(codes=None):
+    """Returns the bundle of the specs with the given codes, every spec when None.
+
+    The fonts and styles they use are included once, font and image files are
+    referenced by name and must be deployed with the media files.
+    """
+    specs = DocumentSpec.objects.order_by('Code')
+    if codes is not None:
+        specs = specs.filter(Code__in=codes)
+        missing = set(codes) - {spec.Code for spec in specs}
+        if missing:
+            raise DocumentSpec.DoesNotExist(f"Unknown document specs: {sorted(missing)}")
+    fonts = {}
+    styles = {}
+    bundle_specs = []
+    for spec in specs:
+        spec_fonts = [font.PDFFont
+                      for font in spec.documentspecfonts_set.select_related('PDFFont')]
+        entry = {'spec': _row(spec, 'spec'), 'fonts': [font.Code for font in spec_fonts]}
+        fonts.update((font.Code, font) for font in spec_fonts)
+        for table in DETAILS:
+            rows = MODELS[table].objects.filter(DocumentSpec=spec).order_by('pk')
+            if table in ('fields', 'labels'):
+                rows = rows.select_related('Style__PDFFont')
+                for row in rows:
+                    styles[row.Style.Code] = row.Style
+                    fonts[row.Style.PDFFont.Code] = row.Style.PDFFont
+            entry[table] = [_row(row, table) for row in rows]
+        bundle_specs.append(entry)
+    return {
+        'format': BUNDLE_FORMAT,
+        'version': BUNDLE_VERSION,
+        'columns': {table: list(columns) for table, columns in COLUMNS.items()},
+        'fonts': [_row(fonts[code], 'fonts') for code in sorted(fonts)],
+        'styles': [_row(styles[code], 'styles') for code in sorted(styles)],
+        'specs': bundle_specs,
+    }
+
+
+def dumps_bundle(bundle, fmt='json'):
+    """Serializes a bundle to bytes, fmt is 'json' or 'msgpack' (needs the msgpack package)."""
+    if fmt == 'msgpack':
+        if msgpack is None:
+            raise ValueError("The msgpack format needs the msgpack package installed")
+        return msgpack.packb(bundle, use_bin_type=True)
+    if fmt == 'json':
+        return json.dumps(bundle, separators=(',', ':')).encode()
+    raise ValueError(f"Unknown bundle format '{fmt}'")
+
+
+def loads_bundle(data, fmt='json'):
+    """Parses the bytes of a bundle and checks its format and version."""
+    if fmt == 'msgpack':
+        if msgpack is None:
+            raise ValueError("The msgpack format needs the msgpack package installed")
+        bundle = msgpack.unpackb(data, raw=False)
+    elif fmt == 'json':
+        bundle = json.loads(data)
+    else:
+        raise ValueError(f"Unknown bundle format '{fmt}'")
+    if not isinstance(bundle, dict) or bundle.get('format') != BUNDLE_FORMAT:
+        raise ValueError("Not a document spec bundle")
+    if bundle.get('version', 0) > BUNDLE_VERSION:
+        raise ValueError(f"Unsupported bundle version {bundle.get('version')}, "
+                         f"this version reads up to {BUNDLE_VERSION}")
+    return bundle
+
+
+def bundle_format(path):
+    """Returns the format of a bundle file from its extension."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in BUNDLE_EXTENSIONS:
+        raise ValueError(f"Bundle files must end with one of {BUNDLE_EXTENSIONS}: {path}")
+    return ext[1:]
+
+
+def write_bundle(bundle, path):
+    with open(path, 'wb') as f:
+        f.write(dumps_bundle(bundle, bundle_format(path)))
+
+
+def read_bundle(path):
+    with open(path, 'rb') as f:
+        return loads_bundle(f.read(), bundle_format(path))
+
+
+def bundle_paths(paths):
+    """Returns the bundle files of paths, the directories are read in name order."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if os.path.splitext(name)[1].lower() in BUNDLE_EXTENSIONS)
+        else:
+            files.append(path)
+    return files
+
+
+def _records(bundle, table, rows):
+    """Returns the rows of a table as dicts, the columns missing from the bundle (written
+    by an older version) get the default of the model field."""
+    columns = bundle['columns'][table]
+    defaults = {column: MODELS[table]._meta.get_field(column).get_default()
+                for column in COLUMNS[table] if column not in columns}
+    return [{**defaults, **dict(zip(columns, row))} for row in rows]
+
+
+def bundle_sources(bundle):
+    """Returns the SpecSource of each spec of the bundle, built without the database."""
+    fonts = {row['Code']: SimpleNamespace(**row)
+             for row in _records(bundle, 'fonts', bundle['fonts'])}
+    styles = {}
+    for row in _records(bundle, 'styles', bundle['styles']):
+        row['PDFFont'] = fonts[row['PDFFont']]
+        styles[row['Code']] = SimpleNamespace(**row)
+    sources = []
+    for entry in bundle['specs']:
+        details = {}
+        for table in DETAILS:
+            rows = _records(bundle, table, entry[table])
+            for row in rows:
+                if 'Style' in row:
+                    row['Style'] = styles[row['Style']]
+            details[table] = [SimpleNamespace(**row) for row in rows]
+        spec, = _records(bundle, 'spec', [entry['spec']])
+        sources.append(SpecSource(
+            spec=SimpleNamespace(**spec),
+            fonts=[SimpleNamespace(PDFFont=fonts[code]) for code in entry['fonts']],
+            **details))
+    return sources
+
+
+def load_bundles(paths):
+    """Registers the specs of the bundle files and directories of paths, their plans
+    are compiled from the bundles without querying the database. Returns their codes."""
+    codes = []
+    for path in bundle_paths(paths):
+        for source in bundle_sources(read_bundle(path)):
+            register_spec_source(source)
+            codes.append(source.spec.Code)
+    return codes
+
+
+def _import_values(table, row):
+    """Keeps the columns of the row that are fields of the model."""
+    return {column: value for column, value in row.items() if column in COLUMNS[table]}
+
+
+@transaction.atomic
+def import_bundle(bundle):
+    """Creates or updates the fonts, styles and specs of the bundle in the database.
+
+    The fields, labels, rects, images and fonts of each imported spec are replaced
+    by the ones of the bundle. Returns the codes of the specs.
+    """
+    fonts = {}
+    for row in _records(bundle, 'fonts', bundle['fonts']):
+        values = _import_values('fonts', row)
+        fonts[row['Code']], _ = PDFFont.objects.update_or_create(
+            Code=values.pop('Code'), defaults=values)
+    styles = {}
+    for row in _records(bundle, 'styles', bundle['styles']):
+        values = _import_values('styles', row)
+        values['PDFFont'] = fonts[values['PDFFont']]
+        styles[row['Code']], _ = FontStyle.objects.update_or_create(
+            Code=values.pop('Code'), defaults=values)
+    codes = []
+    for entry in bundle['specs']:
+        values, = _records(bundle, 'spec', [entry['spec']])
+        values = _import_values('spec', values)
+        spec, _ = DocumentSpec.objects.update_or_create(Code=values.pop('Code'), defaults=values)
+        DocumentSpecFonts.objects.filter(DocumentSpec=spec).delete()
+        DocumentSpecFonts.objects.bulk_create(
+            DocumentSpecFonts(DocumentSpec=spec, PDFFont=fonts[code]) for code in entry['fonts'])
+        for table in DETAILS:
+            model = MODELS[table]
+            model.objects.filter(DocumentSpec=spec).delete()
+            rows = []
+            for row in _records(bundle, table, entry[table]):
+                values = _import_values(table, row)
+                if 'Style' in values:
+                    values['Style'] = styles[values['Style']]
+                rows.append(model(DocumentSpec=spec, **values))
+            model.objects.bulk_create(rows)
+        codes.append(spec.Code)
+    # bulk_create doesn't send the signals that drop the compiled plans.
+    transaction.on_commit(invalidate_layout_plan)
+    return codes
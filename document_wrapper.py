@@ -1,13 +1,37 @@
 # from reportlab.lib.colors import *
+import hashlib
+import logging
+import os
+from contextlib import nullcontext
+from functools import lru_cache
+from itertools import islice
+from math import ceil
+from operator import attrgetter
 from typing import Union
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 from reportlab.lib import pagesizes
-from reportlab.lib.colors import HexColor, getAllNamedColors, lightgrey, black, PCMYKColor
+from reportlab.lib.colors import black, PCMYKColor
 from reportlab.pdfgen import canvas
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab import lib
-from django_document_pdf.text_utils import latin1_to_ascii, wrapText
-from .models import DocumentSpec, PDFFont, FontStyle
+from django_document_pdf.text_utils import wrapText, wrap_text_width
+from .fonts import font_path, register_fonts
+from .instrumentation import RenderStats, log_stats
+from .layout import get_layout_plan, get_color_with_opacity, invalid_field_paths
+from .ops import BACKGROUND, FOREGROUND, OpsBuilder, execute_ops, static_ops
+from .output_stats import output_breakdown
+from .relations import RelationCache, detail_queryset, values_lookup
+from .result_cache import get_result_cache
+from .signals import document_rendered
+
+logger = logging.getLogger(__name__)
+
+# Errors of a field path that is not valid for the record, the field is skipped.
+MISSING_VALUE_ERRORS = (AttributeError, ObjectDoesNotExist)
+
+
+@lru_cache(maxsize=1024)
+def field_accessor(path):
+    return attrgetter(path)
 
 
 class DocumentPDF:
@@ -20,305 +44,431 @@ class DocumentPDF:
     _lastPage = False
     _Fields = {}
     _record = None
-    __cached__ = {}
+    _stats = None
+    _deferStats = False
 
     a4_w, a4_h = pagesizes.A4
     legal_w, legal_h = pagesizes.LEGAL
     ledger_w, ledger_h = pagesizes.LEDGER
 
-    def __init__(self, document_spec_code, filename, record) -> None:
-        document_spec = DocumentSpec.objects.get(
-            Code=document_spec_code)
-        if not document_spec:
-            raise ValueError("Document Spec doesnt exists")
-        active_fonts = document_spec.documentspecfonts_set.all()
-        if not active_fonts:
-            raise AttributeError("Needs active fonts for current document")
-        self.registerFonts(active_fonts)
-        required_keys = ['Width', 'Height']
-
-        if all(getattr(document_spec, key) for key in required_keys):
-            self._Width = document_spec.Width
-            self._Height = document_spec.Height
-            self._RowsPerPage = document_spec.RowsPerPage
-            self._ShowPlaceHolder = document_spec.ShowPlaceHolder
-
-            self._Fields = document_spec.documentspecfields_set.all()
-            self._Rects = document_spec.documentspecrects_set.all()
-            self._Images = document_spec.documentspecimages_set.all()
-            self._Labels = document_spec.documentspeclabels_set.all()
-            self._filename = f"{filename}"
-
-            self._record = record
-        else:
-            missing_keys = [
-                key for key in required_keys if key not in getattr(document_spec, key)]
-            raise ValueError(
-                f"The document spec have missing conf: {missing_keys}")
+    def __init__(self, document_spec_code, filename, record, relation_cache=None,
+                 strict=None, instrument=None, result_cache=None, streaming=False,
+                 chunk_size=None) -> None:
+        """filename can be a path, a writable buffer (BytesIO, HttpResponse...) or None
+        when the document is only read back with getPDFData/streamPDF.
+        relation_cache is a RelationCache shared by several documents, e.g. in a batch.
+        With strict (default: the DOCUMENT_PDF_STRICT setting) field paths that can't be
+        read from the model of the record raise ValueError instead of being skipped.
+        instrument (default: the DOCUMENT_PDF_INSTRUMENT setting) is called with the
+        RenderStats of each render, True logs them. Renders are also measured when
+        the document_rendered signal has receivers.
+        result_cache (default: the DOCUMENT_PDF_RESULT_CACHE setting) stores the PDFs of
+        getPDFData/streamPDF under resultKey, they are then rendered in invariant mode.
+        With streaming the detail rows are read from the database chunk_size (default: a
+        page, up to 2000) at a time and drawn page by page without keeping them, for
+        records with very large details.
+        The rows of prefetch_related are not used and there is no result cache."""
+        if instrument is None:
+            instrument = getattr(settings, 'DOCUMENT_PDF_INSTRUMENT', None)
+        self._instrument = log_stats if instrument is True else instrument or None
+        if self._instrument or document_rendered.has_listeners():
+            self._stats = RenderStats(document_spec_code)
+        with self.measure('spec_load'):
+            plan = get_layout_plan(document_spec_code)
+        if strict is None:
+            strict = getattr(settings, 'DOCUMENT_PDF_STRICT', False)
+        if strict:
+            errors = invalid_field_paths(plan, type(record))
+            if errors:
+                raise ValueError(
+                    f"The document spec {document_spec_code} have invalid fields: {errors}")
+        self._plan = plan
+        self._Width = plan.width
+        self._Height = plan.height
+        self._RowsPerPage = plan.rows_per_page
+        self._ShowPlaceHolder = plan.show_placeholder
+
+        self._Fields = plan.fields
+        self._Rects = plan.rects
+        self._Images = plan.images
+        self._Labels = plan.labels
+        self._filename = (filename if filename is None or hasattr(filename, "write")
+                          else f"{filename}")
+
+        self._record = record
+        self._relationCache = relation_cache if relation_cache is not None else RelationCache()
+        self._detailColumns = {}
+        self._resultCache = result_cache if result_cache is not None else get_result_cache()
+        self._streaming = streaming
+        self._chunkSize = chunk_size
+        if streaming:
+            self._resultCache = None
 
     def createCanvas(self, filename, pagesize=pagesizes.A4):
         # To properly configure documents to genPDF set the PDF FontStyle
-        curCanvas = canvas.Canvas(filename, pagesize)
+        # Cached documents must not depend on the creation time, invariant mode
+        # fixes the dates and the document ID of the PDF.
+        invariant = self._resultCache is not None or self._plan.invariant
+        curCanvas = canvas.Canvas(filename, pagesize, pageCompression=self._plan.page_compression,
+                                  invariant=1 if invariant else None)
         return curCanvas
 
+    def resultKey(self, pagesize=pagesizes.A4):
+        """Returns the content address of the rendered document, a hash of the spec
+        fingerprint and of every value extracted from the record."""
+        doc_class = type(self)
+        digest = hashlib.sha256(f"{doc_class.__module__}.{doc_class.__qualname__}\0"
+                                f"{self._plan.fingerprint}\0{pagesize}\0{self._title}".encode())
+        for dsfield in self._Fields:
+            values = self.headerValues(dsfield) if dsfield.type == 0 else self.detailValues(dsfield)
+            digest.update(f"\1{len(values)}".encode())
+            for value in values:
+                value = "%s" % value
+                digest.update(f"\0{len(value)}:{value}".encode('utf-8', 'surrogatepass'))
+        return digest.hexdigest()
+
+    def getPDFData(self, pagesize=pagesizes.A4):
+        """Renders the document and returns the PDF bytes without writing any file.
+        With a result cache, unchanged documents are read from it instead."""
+        key = None
+        if self._resultCache is not None:
+            key = self.resultKey(pagesize)
+            data = self._resultCache.get(key)
+            if data is not None:
+                return data
+        curCanvas = self.createCanvas(self._filename, pagesize)
+        self._deferStats = True
+        try:
+            self.generatePDF(curCanvas=curCanvas)
+            with self.measure('save'):
+                data = curCanvas.getpdfdata()
+        finally:
+            self._deferStats = False
+        self.reportStats(len(data), data)
+        if key is not None:
+            self._resultCache.set(key, data)
+        return data
+
+    def measure(self, phase):
+        """Times the block and counts its queries as a phase of the render, when instrumented."""
+        return self._stats.phase(phase) if self._stats is not None else nullcontext()
+
+    def reportStats(self, output_bytes=None, data=None, saved=False):
+        """Hands the measurements of the render to the instrument and the
+        document_rendered signal, the next render starts new ones.
+
+        Warns when the output is over the SizeBudget of the spec, with the
+        breakdown of its bytes. The breakdown is made from data, or read back
+        from the filename when the render just saved to it (saved).
+        """
+        stats = self._stats
+        over_budget = (output_bytes is not None and self._plan.size_budget
+                       and output_bytes > self._plan.size_budget)
+        breakdown = None
+        if over_budget or (stats is not None and self._plan.output_stats):
+            if data is None and saved:
+                data = self.outputData()
+            if data is not None:
+                breakdown = output_breakdown(data)
+        if over_budget:
+            logger.warning("Document %s is %s bytes, over its budget of %s bytes: %s",
+                           self._plan.code, output_bytes, self._plan.size_budget,
+                           breakdown)
+        if stats is None:
+            return
+        stats.pages = self._lastPage
+        stats.output_bytes = output_bytes
+        stats.output_breakdown = breakdown if self._plan.output_stats else None
+        self._stats = RenderStats(stats.spec_code)
+        if self._instrument:
+            self._instrument(stats)
+        document_rendered.send(sender=type(self), document=self, stats=stats)
+
+    def streamPDF(self, chunk_size=64 * 1024, pagesize=pagesizes.A4):
+        """Renders the document and returns an iterator over chunks of the PDF bytes.
+
+        The chunks are views on the rendered data, so it is not buffered a second
+        time when used as the content of a StreamingHttpResponse.
+        """
+        data = memoryview(self.getPDFData(pagesize))
+        return (data[idx:idx + chunk_size] for idx in range(0, len(data), chunk_size))
+
     def lastPageNr(self):
-        # returns 0 if the record has no details.
-        # Otherwise returns the number of rows of the detail wich has the biggest number of rows
+        # returns 1 if the record has no details.
+        # Otherwise returns the pages needed by the detail wich has the biggest number of rows
         res = 1
+        if self._RowsPerPage:
+            rows = max((self.detailCount(relation)
+                       for relation in self._plan.relations), default=0)
+            res = max(1, ceil(rows / self._RowsPerPage))
         self._lastPage = res
         return res
 
+    def detailRows(self, relation):
+        """Returns the rows of a detail relation of the record, fetched once per document."""
+        return self._relationCache.rows(self._record, relation)
+
+    def detailCount(self, relation):
+        """Returns the number of rows of a detail relation, counted by the database
+        when streaming."""
+        if not self._streaming:
+            return len(self.detailRows(relation))
+        manager = getattr(self._record, relation, None)
+        return manager.count() if manager is not None else 0
+
+    def detailAccessors(self, relation):
+        return {dsfield.path: dsfield.accessor for dsfield in self._Fields
+                if dsfield.relation == relation}
+
+    def extractColumns(self, rows, accessors):
+        """Returns {path: values} of the rows. A row whose path can't be read (a null
+        foreign key on the way) gets a blank value so the columns stay aligned, a path
+        that can't be read from any row is not valid and its column is left empty."""
+        columns = {path: [] for path in accessors}
+        read = set()
+        for row in rows:
+            for path, accessor in accessors.items():
+                try:
+                    columns[path].append(accessor(row))
+                    read.add(path)
+                except MISSING_VALUE_ERRORS:
+                    columns[path].append('')
+        return {path: values if path in read else [] for path, values in columns.items()}
+
+    def detailColumns(self, relation):
+        """Returns {path: values} for the detail fields of the relation.
+
+        Every column is extracted in a single pass over the rows. When streaming,
+        the columns of the page being drawn.
+        """
+        if relation not in self._detailColumns:
+            self._detailColumns[relation] = self.extractColumns(
+                self.detailRows(relation), self.detailAccessors(relation))
+        return self._detailColumns[relation]
+
+    def streamDetailColumns(self, relation):
+        """Yields the {path: values} of the detail fields of the relation for each page.
+
+        Only the columns of the spec are read, with values_list when every path is a
+        model field, the rows are fetched chunk_size at a time and dropped once drawn.
+        """
+        queryset = detail_queryset(self._plan, self._record, relation)
+        if queryset is None:
+            return
+        accessors = self.detailAccessors(relation)
+        lookups = [values_lookup(queryset.model, path) for path in accessors]
+        rows_per_page = self._RowsPerPage or 999999999
+        chunk_size = self._chunkSize or min(rows_per_page, 2000)
+        if None not in lookups:
+            rows = queryset.values_list(*lookups).iterator(chunk_size=chunk_size)
+            while page := list(islice(rows, rows_per_page)):
+                yield dict(zip(accessors, map(list, zip(*page))))
+        else:
+            rows = queryset.iterator(chunk_size=chunk_size)
+            while page := list(islice(rows, rows_per_page)):
+                yield self.extractColumns(page, accessors)
+
+    def detailValues(self, dsfield):
+        """Returns the column of values of a detail field, extracted once per document."""
+        return self.detailColumns(dsfield.relation)[dsfield.path]
+
+    def headerValues(self, dsfield):
+        try:
+            return [dsfield.accessor(self._record)]
+        except MISSING_VALUE_ERRORS:
+            return []
+
+    def staticForms(self, curCanvas):
+        """Returns the names of the background (images) and foreground (labels, rects)
+        forms of the spec, None for an empty layer.
+
+        They don't depend on the record, so each one is drawn once per canvas as a
+        form XObject and every page of every document on the canvas stamps it.
+        """
+        forms = curCanvas.__dict__.setdefault('_ddp_static_forms', {})
+        key = (self._plan.code, self._plan.version)
+        if key not in forms:
+            images, labels, rects = static_ops(self._plan)
+            background = foreground = None
+            if images:
+                background = f'ddpstatic{len(forms)}bg'
+                curCanvas.beginForm(background)
+                self.executeOps(curCanvas, images, phase='images')
+                curCanvas.endForm()
+            if labels or rects:
+                foreground = f'ddpstatic{len(forms)}fg'
+                curCanvas.beginForm(foreground)
+                self.executeOps(curCanvas, labels, phase='labels')
+                self.executeOps(curCanvas, rects, phase='rects')
+                curCanvas.endForm()
+            forms[key] = (background, foreground)
+        return forms[key]
+
     def generatePDF(self, curCanvas=None, documentspec=None, pagesize=pagesizes.A4):
 
         saveCanvas = False
         if not curCanvas:
+            if self._filename is None:
+                raise ValueError("The document has no filename or buffer to save to, "
+                                 "use getPDFData or streamPDF to render it without one")
             saveCanvas = True
             curCanvas = self.createCanvas(self._filename, pagesize)
 
-        curCanvas.getAvailableFonts()
-        availableColors = getAllNamedColors()
         curCanvas.setAuthor("Django_document_pdf Generator")
         curCanvas.setTitle(self._title)
 
-        resizeFieldFactor = 1
+        # Plan coordinates are translated for a page of the spec size.
         curCanvas.setPageSize((self._Width, self._Height))
-        page_width = curCanvas._pagesize[0]
-        page_height = curCanvas._pagesize[1]
-        wrate = page_width / self._Width
-        hrate = page_height / self._Height
-
-        def translateCoords(x, y, invert_Y=True):
-            x = int(x * wrate)
-            if invert_Y:
-                y = int(page_height - (y * hrate))
-            else:
-                y = int(y * hrate)
-            return x, y
-        rows_per_page = self._RowsPerPage
-        if not rows_per_page:
-            rows_per_page = 999999999
-        cur_page = 1
-        max_rows = 1
-        while cur_page <= self.lastPageNr():
-            if cur_page == self.lastPageNr():
-                # If this method exists call it to set the values for the fields in the lastPage
-                lastPageMethod = "onLastPage"
-                runLast = None
-                if hasattr(self, lastPageMethod):
-                    runLast = getattr(self, lastPageMethod)
-                if runLast:
-                    runLast()
-            for dsimage in self._Images:
-                x = dsimage.X
-                y = dsimage.Y
-                xx, yy = translateCoords(x, y)
-                w, dummy = translateCoords(dsimage.Width, 1, False)
-                h = int(hrate * float(dsimage.Height))
-                yy -= h
-                try:
-                    if dsimage.Watermark:
-                        curCanvas.setFillColor(
-                            lightgrey, alpha=float(dsimage.WatermarkOpacity))
-                    curCanvas.drawImage(
-                        f'media/{dsimage.Filename}', xx, yy, w, h)
-                except IOError:
-                    pass
-            curCanvas.setFillColor(black, alpha=1)
-            for dsfield in self._Fields:
-                fstyle = FontStyle.objects.get(Code=dsfield.Style.Code)
-                if not fstyle:
-                    continue
-                if dsfield.Type == 0:  # header
-                    fvalues = self.getFields(self._record, dsfield.Field, [])
-                else:
-                    # detail
-                    dsfield_clean = dsfield.Field.split(".")
-                    check = hasattr(
-                        self._record, f'{dsfield_clean[0]}_set'.lower())
-                    if check:
-                        rows = getattr(
-                            self._record, f'{dsfield_clean[0]}_set'.lower())
-                        rows = self.cacheGetorCreate(
-                            rows, f'{dsfield_clean[0]}_set'.lower())
-                    else:
-                        rows = []
-                    data = []
-                    for row in rows:
-                        data = self.getFields(
-                            row, ".".join(dsfield_clean[1:]), data)
-                    fvalues = data
-                x = dsfield.X
-                y = dsfield.Y
-                # show place holder when record wasnt have attr
-                if not fvalues and self._ShowPlaceHolder:  # and dsfield.Type == 0:
-                    xx, yy = translateCoords(x, y)
-                    curCanvas.setFillColor(
-                        self.get_color_with_opacity("red", 100))
-                    curCanvas.drawString(xx, yy, dsfield.Field)
-                    curCanvas.setFillColor(
-                        self.get_color_with_opacity("black", 100))
-
-                max_rows = max(max_rows, len(fvalues))
-                fromidx = 0
-                toidx = 9999999
-                if dsfield.Type == 1:  # detail
-                    fromidx = (cur_page-1)*rows_per_page
-                    toidx = cur_page*rows_per_page
-                for fvalue in fvalues[fromidx:toidx]:
-                    xx, yy = translateCoords(x, y)
-                    if fstyle.Color.startswith("#"):
-                        rgb = HexColor(fstyle.Color)
-                    elif fstyle.Color in availableColors.keys():
-                        rgb = availableColors[fstyle.Color]
-                    else:
-                        rgb = HexColor("#000000")
-                    curCanvas.setFillColorRGB(rgb.red, rgb.green, rgb.blue)
-                    curCanvas.setFont(fstyle.PDFFont.Code, int(
-                        fstyle.Size*resizeFieldFactor), True)
-                    asc, desc = pdfmetrics.getAscentDescent(
-                        fstyle.PDFFont.Code, int(fstyle.Size*resizeFieldFactor))
-                    yy -= +asc-desc
-                    tlimit, width = (dsfield.TextLimit, dsfield.Width)
-                    if (tlimit):
-                        # tx.textLines
-                        # c.drawText(tx)
-                        lines = self.wrapText(fvalue, tlimit)
-                        fvalue = "\n".join(lines)
-                    elif (width):
-                        print("No implemented yet")
-                    fvalue = "%s" % fvalue  # temp
-                    jumps = len(fvalue.split("\n"))
-                    for value in fvalue.split("\n"):
-                        try:
-                            if dsfield.Alignment and dsfield.Width:
-                                if dsfield.Alignment == self.CENTER:
-                                    xx += int((dsfield.Width)/2)
-                                    curCanvas.drawCentredString(xx, yy, value)
-                                elif dsfield.Alignment == self.RIGHT:
-                                    xx += int(dsfield.Width)
-                                    curCanvas.drawRightString(xx, yy, value)
-                            else:
-                                curCanvas.drawString(xx, yy, value)
-                        except UnicodeDecodeError:
-                            if fvalue is not None:
-                                fvalue = latin1_to_ascii(value)
-                            try:
-                                if dsfield.Alignment and dsfield.Width:
-                                    if dsfield.Alignment == self.CENTER:
-                                        xx += int((dsfield.Width)/2)
-                                        curCanvas.drawCentredString(
-                                            xx, yy, value)
-                                    elif dsfield.Alignment == self.RIGHT:
-                                        xx += int(dsfield.Width)
-                                        curCanvas.drawRightString(
-                                            xx, yy, value)
-                                else:
-                                    curCanvas.drawString(xx, yy, value)
-                            except UnicodeDecodeError:
-                                if dsfield.Alignment and dsfield.Width:
-                                    if dsfield.Alignment == self.CENTER:
-                                        xx += int((dsfield.Width)/2)
-                                        curCanvas.drawCentredString(
-                                            xx, yy, repr(value))
-                                    elif dsfield.Alignment == self.RIGHT:
-                                        xx += int(dsfield.Width)
-                                        curCanvas.drawRightString(
-                                            xx, yy, repr(value))
-                                else:
-                                    curCanvas.drawString(xx, yy, repr(value))
-                        yy -= 12
-                    y += 15 * jumps
-
-            for dslabel in self._Labels:
-                fstyle = FontStyle.objects.get(Code=dslabel.Style.Code)
-                if not fstyle:
-                    continue
-                x = dslabel.X
-                y = dslabel.Y
-                xx, yy = translateCoords(x, y)
-                if fstyle.Color.startswith("#"):
-                    rgb = HexColor(fstyle.Color)
-                # elif fstyle.Color in availableColors.keys():
-                #    rgb = availableColors[fstyle.Color]
-                else:
-                    rgb = HexColor("#000000")
-                curCanvas.setFillColorRGB(rgb.red, rgb.green, rgb.blue)
-                curCanvas.setFont(fstyle.PDFFont.Code, int(
-                    fstyle.Size*resizeFieldFactor), True)
-                asc, desc = pdfmetrics.getAscentDescent(
-                    fstyle.PDFFont.Code, int(fstyle.Size*resizeFieldFactor))
-                yy -= +asc-desc
-                try:
-                    curCanvas.drawString(xx, yy, dslabel.Text)
-                except UnicodeDecodeError:
-                    if dslabel['Text'] is not None:
-                        fvalue = latin1_to_ascii(dslabel.Text)
-                    try:
-                        curCanvas.drawString(xx, yy, fvalue)
-                    except UnicodeDecodeError:
-                        curCanvas.drawString(xx, yy, repr(fvalue))
-
-            for dsrect in self._Rects:
-                if not dsrect.Show:
-                    continue
-                x = dsrect.X
-                y = dsrect.Y
-                w = dsrect.Width
-                h = dsrect.Height
-
-                bx, by = translateCoords(x, y)
-                ex, ey = translateCoords(x+w, y+h)
-                if not dsrect.Rounded:
-                    curCanvas.rect(bx, by, ex-bx, ey-by)
-                else:
-                    if dsrect.Radius:
-                        if dsrect.Fill:
-                            curCanvas.setFillColor(
-                                self.get_color_with_opacity(dsrect.FillColor, dsrect.FillColorAlpha))
-                        if dsrect.Stroke:
-                            curCanvas.setStrokeColor(
-                                self.get_color_with_opacity(dsrect.StrokeColor, dsrect.StrokeColorAlpha))
-                        curCanvas.roundRect(
-                            bx, by, ex-bx, ey-by, 10, fill=dsrect.Fill, stroke=dsrect.Stroke)
-                        curCanvas.setFillColor(black, alpha=1)
-                    else:
-                        raise AttributeError(
-                            "Needs define radius for rounded rects")
-
-            curCanvas.showPage()
-            cur_page += 1
+
+        if self._streaming:
+            self.streamPages(curCanvas)
+        else:
+            with self.measure('data'):
+                self.lastPageNr()
+                for relation in self._plan.relations:
+                    self.detailColumns(relation)
+            with self.measure('layout'):
+                ops = self.buildOps()
+            self.executeOps(curCanvas, ops, self.staticForms(curCanvas), phase='fields')
 
         if saveCanvas:
-            curCanvas.save()
+            with self.measure('save'):
+                curCanvas.save()
+            measured = self._stats is not None or self._plan.size_budget
+            self.reportStats(self.outputSize() if measured else None, saved=True)
+        elif not self._deferStats:
+            self.reportStats()
         return curCanvas
 
+    def executeOps(self, curCanvas, ops, forms=None, phase='fields'):
+        """Draws DrawOps on the canvas, measured as the given phase."""
+        with self.measure(phase):
+            execute_ops(ops, curCanvas, forms)
+        if self._stats is not None:
+            self._stats.draw_calls += ops.draw_calls
+
+    def buildOps(self):
+        """Lays out the record on the pages of the spec and returns their DrawOps.
+
+        Nothing is drawn, the ops can be executed later on any canvas with
+        executeOps, cached or sent to another process.
+        """
+        ops = OpsBuilder()
+        last_page = self.lastPageNr()
+        # Detail columns are consumed page by page from a single iterator.
+        detailIters = {}
+        cur_page = 1
+        while cur_page <= last_page:
+            self.layoutPage(ops, cur_page, detailIters)
+            cur_page += 1
+        images, labels, rects = static_ops(self._plan)
+        return ops.build(layers=((images,), (labels, rects)))
+
+    def streamPages(self, curCanvas):
+        """Reads, lays out and draws the detail rows one page at a time."""
+        with self.measure('data'):
+            last_page = self.lastPageNr()
+            pages = {relation: self.streamDetailColumns(relation)
+                     for relation in self._plan.relations}
+            for relation in pages:
+                self._detailColumns[relation] = dict.fromkeys(self.detailAccessors(relation), [])
+        forms = self.staticForms(curCanvas)
+        detailIters = {}
+        for cur_page in range(1, last_page + 1):
+            with self.measure('data'):
+                for relation, stream in pages.items():
+                    columns = next(stream, None)
+                    # A relation with fewer pages keeps its last columns, so its fields
+                    # don't show the placeholder, with nothing left to draw.
+                    if columns is not None:
+                        self._detailColumns[relation] = columns
+                    for dsfield in self._Fields:
+                        if dsfield.relation == relation:
+                            detailIters[dsfield] = iter(columns[dsfield.path]
+                                                        if columns is not None else ())
+            with self.measure('layout'):
+                ops = OpsBuilder()
+                self.layoutPage(ops, cur_page, detailIters)
+            self.executeOps(curCanvas, ops.build(), forms, phase='fields')
+
+    def layoutPage(self, ops, cur_page, detailIters):
+        """Adds a page of the document to ops."""
+        if cur_page == self._lastPage:
+            # If this method exists call it to set the values for the fields in the lastPage
+            lastPageMethod = "onLastPage"
+            runLast = None
+            if hasattr(self, lastPageMethod):
+                runLast = getattr(self, lastPageMethod)
+            if runLast:
+                runLast()
+        ops.static(BACKGROUND)
+        ops.fill_color(black, 1)
+        self.layoutFields(ops, detailIters, self._RowsPerPage or 999999999)
+        ops.static(FOREGROUND)
+        ops.page()
+
+    def layoutFields(self, ops, detailIters, rows_per_page):
+        """Adds the values of the fields on the current page, detailIters holds the
+        iterator of each detail column across the pages."""
+        for dsfield in self._Fields:
+            fstyle = dsfield.style
+            if dsfield.type == 0:  # header
+                fvalues = self.headerValues(dsfield)
+            else:
+                # detail
+                fvalues = self.detailValues(dsfield)
+            # show place holder when record wasnt have attr
+            if not fvalues and self._ShowPlaceHolder:  # and dsfield.Type == 0:
+                ops.fill_color(self.get_color_with_opacity("red", 100))
+                ops.text(dsfield.x, dsfield.y + fstyle.ascent - fstyle.descent, dsfield.field)
+                ops.fill_color(self.get_color_with_opacity("black", 100))
+
+            if dsfield.type == 1:  # detail
+                if dsfield not in detailIters:
+                    detailIters[dsfield] = iter(fvalues)
+                fvalues = islice(detailIters[dsfield], rows_per_page)
+            yy = dsfield.y
+            for fvalue in fvalues:
+                ops.style(fstyle)
+                if dsfield.text_limit:
+                    lines = wrapText("%s" % fvalue, dsfield.text_limit)
+                elif dsfield.width:
+                    lines = wrap_text_width("%s" % fvalue, fstyle.font, fstyle.size,
+                                            dsfield.width)
+                else:
+                    lines = ("%s" % fvalue).split("\n")
+                line_y = yy
+                for value in lines:
+                    ops.text(dsfield.anchor, line_y, value, dsfield.alignment)
+                    line_y -= 12
+                yy -= 15 * len(lines)
+
+    def outputSize(self):
+        """Returns the size of the saved PDF, None when it can't be known."""
+        if hasattr(self._filename, "tell"):
+            try:
+                return self._filename.tell()
+            except (OSError, ValueError):  # Pipes, closed buffers...
+                return None
+        if isinstance(self._filename, (str, os.PathLike)) and os.path.exists(self._filename):
+            return os.path.getsize(self._filename)
+        return None
+
+    def outputData(self):
+        """Returns the bytes of the saved PDF, None when they can't be read back."""
+        if hasattr(self._filename, "getvalue"):
+            return self._filename.getvalue()
+        if isinstance(self._filename, (str, os.PathLike)) and os.path.exists(self._filename):
+            with open(self._filename, 'rb') as f:
+                return f.read()
+        return None
+
     def get_color_with_opacity(self, color: str, opacity: float) -> Union[PCMYKColor, None]:
-        COLOR_MAP = {
-            "red": PCMYKColor(0, 100, 100, 0),
-            "orange": PCMYKColor(0, 50, 100, 0),
-            "black": PCMYKColor(0, 0, 0, 100),
-            "blue": PCMYKColor(100, 50, 0, 0),
-            "pink": PCMYKColor(0, 100, 0, 0),
-            "purple": PCMYKColor(50, 100, 0, 0),
-            "brown": PCMYKColor(30, 60, 90, 40),
-            "green": PCMYKColor(100, 0, 100, 0),
-            "yellow": PCMYKColor(0, 0, 100, 0),
-        }
-        color = color.lower()
-        matched_color = COLOR_MAP.get(color)
-
-        if matched_color is not None:
-            return matched_color.clone(alpha=opacity)
-        else:
-            print(
-                f"(get_color_with_opacity)Color '{color}' not found. Skipped.")
-            return None
+        return get_color_with_opacity(color, opacity)
 
     @classmethod
     def registerFonts(cls, fonts):
-        for font in fonts:
-            pdfmetrics.registerFont(
-                TTFont(font.PDFFont.Code, f'media/{font.PDFFont.Font}'))
+        register_fonts((font.PDFFont.Code, font_path(font.PDFFont)) for font in fonts)
 
     def getFields(self, record, field, data):
         """Retrieves fields from a nested record structure by fk, handling dotted field paths.
@@ -333,22 +483,12 @@ class DocumentPDF:
         """
 
         try:
-            field_parts = field.split(".")
-            current_value = record
-
-            for part in field_parts[:-1]:  # Iterate through nested parts
-                current_value = getattr(current_value, part)
-
-            # Append final field value
-            data.append(getattr(current_value, field_parts[-1]))
-
-        except Exception:
+            data.append(field_accessor(field)(record))
+        except MISSING_VALUE_ERRORS:
             return []
 
         return data
 
     def cacheGetorCreate(self, record, key):
         """prevent incur multiple queries on the same transaction row table """
-        if key not in self.__cached__:
-            self.__cached__[key] = record.all()
-        return self.__cached__[key]
+        return self._relationCache.rows(self._record, key)
@@ -0,0 +1,82 @@
+import hashlib
+import logging
+import mmap
+import os
+import threading
+import time
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from .text_utils import string_width
+
+logger = logging.getLogger(__name__)
+
+# Process wide registry of the fonts handed to reportlab, code -> content digest.
+_registered = {}
+# (path, mtime, size) -> digest, so unchanged files are not hashed again.
+_digests = {}
+# Seconds spent parsing and registering each font code, for monitoring.
+registration_times = {}
+# Seconds spent registering fonts since the process started.
+registration_seconds = 0.0
+_lock = threading.Lock()
+
+
+def font_path(font):
+    """Returns the path of the file of a PDFFont."""
+    return f'media/{font.Font}'
+
+
+def font_digest(path):
+    """Returns the sha256 of the font file, the file is memory mapped instead of read."""
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    digest = _digests.get(key)
+    if digest is None:
+        with open(path, 'rb') as f:
+            if stat.st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    digest = hashlib.sha256(data).hexdigest()
+            else:
+                digest = hashlib.sha256(b'').hexdigest()
+        _digests[key] = digest
+    return digest
+
+
+def register_font(code, path):
+    """Registers the TrueType font once per process.
+
+    The font is parsed again only when its file content changed, e.g. when the
+    PDFFont was uploaded again. Returns True when the font was (re)registered.
+    """
+    global registration_seconds
+    digest = font_digest(path)
+    if _registered.get(code) == digest:
+        return False
+    with _lock:
+        if _registered.get(code) == digest:
+            return False
+        start = time.perf_counter()
+        pdfmetrics.registerFont(TTFont(code, path))
+        registration_times[code] = time.perf_counter() - start
+        registration_seconds += registration_times[code]
+        _registered[code] = digest
+        # Widths measured with the previous file of the font are stale.
+        string_width.cache_clear()
+    logger.debug("Registered font %s from %s in %.3fs", code, path, registration_times[code])
+    return True
+
+
+def register_fonts(fonts):
+    """Registers an iterable of (code, path) pairs."""
+    for code, path in fonts:
+        register_font(code, path)
+
+
+def warm_fonts():
+    """Registers every PDFFont, used at startup with DOCUMENT_PDF_WARM_FONTS."""
+    from .models import PDFFont
+    for font in PDFFont.objects.all():
+        try:
+            register_font(font.Code, font_path(font))
+        except OSError as e:
+            logger.warning("Can't register font %s: %s", font.Code, e)
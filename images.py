@@ -0,0 +1,126 @@
+import copy
+import logging
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from reportlab.lib.utils import ImageReader
+
+logger = logging.getLogger(__name__)
+
+
+class CachedImage:
+    """A decoded image and, once it was embedded, its encoded PDF image XObject."""
+    __slots__ = ('reader', 'cost', 'name', 'xobject')
+
+    def __init__(self, reader, cost):
+        self.reader = reader
+        self.cost = cost
+        self.name = None
+        self.xobject = None
+
+
+class ImageCache:
+    """LRU of decoded images bounded by their estimated size in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Returns the CachedImage of the file, or None when it can't be read."""
+        with self._lock:
+            if path in self._items:
+                self._items.move_to_end(path)
+                return self._items[path]
+        try:
+            reader = ImageReader(path)
+            # Decode now so every later document reuses the pixel data.
+            item = CachedImage(reader, len(reader.getRGBData()))
+        except OSError as e:
+            logger.warning("Image %s not available: %s", path, e)
+            item = None
+        with self._lock:
+            if path not in self._items:
+                self._items[path] = item
+                self.size += item.cost if item else 0
+            self._evict()
+        return item
+
+    def add_cost(self, item, cost):
+        with self._lock:
+            item.cost += cost
+            self.size += cost
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self._items) > 1:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= evicted.cost if evicted else 0
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+_cache = None
+
+
+def get_image_cache():
+    global _cache
+    if _cache is None:
+        _cache = ImageCache(getattr(settings, 'DOCUMENT_PDF_IMAGE_CACHE_BYTES', 64 * 1024 * 1024))
+    return _cache
+
+
+def _embed_image(curCanvas, item):
+    """Adds the XObject encoded for a previous document to this canvas.
+
+    Mirrors what Canvas.drawImage does for a new image, so the following
+    drawImage call finds it and skips compressing and encoding the pixels.
+    """
+    doc = curCanvas._doc
+    regName = doc.getXObjectName(item.name)
+    if regName not in doc.idToObject:
+        xobject = copy.copy(item.xobject)
+        # Drop the registration name given by the document it was created in.
+        xobject.__dict__.pop('__InternalName__', None)
+        curCanvas._setXObjects(xobject)
+        doc.Reference(xobject, regName)
+        doc.addForm(item.name, xobject)
+
+
+def draw_cached_image(curCanvas, path, x, y, width, height):
+    """Draws the image through a unit sized form XObject stored once per canvas.
+
+    Every page of the document references the same XObject and the encoded
+    image data is shared by all the documents of the process.
+    Returns False when the image file is not available.
+    """
+    forms = curCanvas.__dict__.setdefault('_ddp_image_forms', {})
+    name = forms.get(path)
+    if name is None:
+        cache = get_image_cache()
+        item = cache.get(path)
+        if item is None:
+            return False
+        name = f'ddpimage{len(forms)}'
+        curCanvas.beginForm(name, lowerx=0, lowery=0, upperx=1, uppery=1)
+        if item.xobject is not None:
+            _embed_image(curCanvas, item)
+        created = {'name': None, 'imgObj': None}
+        curCanvas.drawImage(item.reader, 0, 0, 1, 1, extraReturn=created)
+        # Images with a soft mask reference a second object, those are not shared.
+        if item.xobject is None and getattr(created['imgObj'], 'smask', None) is None:
+            item.name, item.xobject = created['name'], created['imgObj']
+            cache.add_cost(item, len(item.xobject.streamContent))
+        curCanvas.endForm()
+        forms[path] = name
+    curCanvas.saveState()
+    curCanvas.translate(x, y)
+    curCanvas.scale(width, height)
+    curCanvas.doForm(name)
+    curCanvas.restoreState()
+    return True
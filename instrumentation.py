@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from django.db import connections
+from . import fonts
+
+logger = logging.getLogger(__name__)
+
+PHASES = ('spec_load', 'fonts', 'data', 'layout', 'images', 'fields', 'labels', 'rects', 'save')
+
+
+class RenderStats:
+    """Measurements of a DocumentPDF render: seconds and queries per phase, draw calls,
+    pages and output size (None when the canvas is saved by the caller).
+    output_breakdown has the bytes of the output per part when the spec has OutputStats.
+
+    Font registration is accounted as its own phase whatever phase triggered it.
+    """
+
+    def __init__(self, spec_code):
+        self.spec_code = spec_code
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.phase_queries = dict.fromkeys(PHASES, 0)
+        self.draw_calls = 0
+        self.pages = 0
+        self.output_bytes = None
+        self.output_breakdown = None
+
+    @property
+    def seconds(self):
+        return sum(self.phases.values())
+
+    @property
+    def queries(self):
+        return sum(self.phase_queries.values())
+
+    @contextmanager
+    def phase(self, name):
+        """Adds the time and the queries of the block to the phase."""
+        def count_query(execute, sql, params, many, context):
+            self.phase_queries[name] += 1
+            return execute(sql, params, many, context)
+
+        registering = fonts.registration_seconds
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for conn in connections.all():
+                    stack.enter_context(conn.execute_wrapper(count_query))
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            registering = fonts.registration_seconds - registering
+            self.phases['fonts'] += registering
+            self.phases[name] += elapsed - registering
+
+    def as_dict(self):
+        return {'spec': self.spec_code, 'seconds': self.seconds, 'phases': dict(self.phases),
+                'queries': self.queries, 'draw_calls': self.draw_calls, 'pages': self.pages,
+                'output_bytes': self.output_bytes, 'output_breakdown': self.output_breakdown}
+
+    def __str__(self):
+        phases = ", ".join(f"{name} {seconds * 1000:.1f}ms"
+                           for name, seconds in self.phases.items() if seconds)
+        return (f"{self.spec_code}: {self.seconds * 1000:.1f}ms, {self.pages} pages, "
+                f"{self.queries} queries, {self.draw_calls} draw calls, "
+                f"{self.output_bytes} bytes ({phases})")
+
+
+def log_stats(stats):
+    """Default reporter, logs a line per render."""
+    logger.info("Rendered %s", stats)
+
+
+class PrometheusMetrics:
+    """Counters and histograms of the renders kept in process.
+
+    expose() returns them in the Prometheus text format, to be served by any
+    view or written for a textfile collector, no metrics server is needed.
+    Use an instance as the instrument callback of the documents or connect
+    its receiver to the document_rendered signal.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    SIZE_BUCKETS = (10_000, 50_000, 100_000, 500_000, 1_000_000, 5_000_000)
+
+    def __init__(self, prefix='document_pdf'):
+        self.prefix = prefix
+        self._counters = defaultdict(float)
+        # (name, labels) -> [count per bucket, sum, count]
+        self._histograms = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, stats):
+        spec = (('spec', stats.spec_code),)
+        with self._lock:
+            self._inc('documents_total', spec, 1)
+            self._inc('pages_total', spec, stats.pages)
+            self._inc('queries_total', spec, stats.queries)
+            self._inc('draw_calls_total', spec, stats.draw_calls)
+            self._observe('render_seconds', spec, stats.seconds, self.BUCKETS)
+            for name, seconds in stats.phases.items():
+                self._observe('phase_seconds', spec + (('phase', name),), seconds, self.BUCKETS)
+            if stats.output_bytes is not None:
+                self._observe('output_bytes', spec, stats.output_bytes, self.SIZE_BUCKETS)
+            if stats.output_breakdown is not None:
+                for part in ('fonts', 'images', 'content', 'other'):
+                    self._inc('output_part_bytes_total', spec + (('part', part),),
+                              stats.output_breakdown[part])
+
+    def receiver(self, sender, stats, **kwargs):
+        self(stats)
+
+    def _inc(self, name, labels, value):
+        self._counters[(name, labels)] += value
+
+    def _observe(self, name, labels, value, buckets):
+        self._buckets[name] = buckets
+        histogram = self._histograms.setdefault((name, labels), [[0] * len(buckets), 0.0, 0])
+        idx = bisect_left(buckets, value)
+        if idx < len(buckets):
+            histogram[0][idx] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    @staticmethod
+    def _labels(labels):
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+    def expose(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                for (metric, labels), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f"{self.prefix}_{name}{self._labels(labels)} {value:g}")
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {self.prefix}_{name} histogram")
+                for (metric, labels), (counts, total, count) in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(self._buckets[name], counts):
+                        cumulative += bucket_count
+                        lines.append(f"{self.prefix}_{name}_bucket"
+                                     f"{self._labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+                    lines.append(f"{self.prefix}_{name}_bucket"
+                                 f"{self._labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{self.prefix}_{name}_sum{self._labels(labels)} {total:g}")
+                    lines.append(f"{self.prefix}_{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
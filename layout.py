@@ -0,0 +1,403 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from functools import lru_cache
+from operator import attrgetter
+from types import MappingProxyType
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from reportlab.lib.colors import HexColor, getAllNamedColors, PCMYKColor
+from reportlab.pdfbase import pdfmetrics
+from .fonts import font_digest, font_path, register_fonts
+from .models import DocumentSpec
+
+logger = logging.getLogger(__name__)
+
+
+class _Frozen:
+    """Base for the immutable, slot based snapshots that make up a LayoutPlan."""
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kwargs[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __repr__(self):
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({values})"
+
+
+class StylePlan(_Frozen):
+    __slots__ = ('code', 'font', 'size', 'rgb', 'ascent', 'descent')
+
+
+class FieldPlan(_Frozen):
+    # x, y are already translated to canvas coordinates for the first line,
+    # anchor is the x where the aligned string is drawn.
+    # Detail fields read `path` from each row of the `relation` of the record,
+    # accessor is the compiled attrgetter of the path.
+    __slots__ = ('field', 'type', 'relation', 'path', 'accessor', 'x', 'y', 'anchor',
+                 'alignment', 'width', 'text_limit', 'decimals', 'style')
+
+
+class LabelPlan(_Frozen):
+    __slots__ = ('text', 'x', 'y', 'alignment', 'style')
+
+
+class RectPlan(_Frozen):
+    __slots__ = ('x', 'y', 'width', 'height', 'rounded', 'radius',
+                 'fill', 'fill_color', 'stroke', 'stroke_color')
+
+
+class ImagePlan(_Frozen):
+    __slots__ = ('filename', 'x', 'y', 'width', 'height', 'watermark', 'opacity')
+
+
+class SpecSource(_Frozen):
+    """The rows a LayoutPlan is compiled from: the DocumentSpec and its DocumentSpecFonts,
+    fields, labels, rects and images. Models, or any objects with the same attributes
+    as the ones of a bundle."""
+    __slots__ = ('spec', 'fonts', 'fields', 'labels', 'rects', 'images')
+
+
+class LayoutPlan(_Frozen):
+    # fingerprint is a hash of the content of the spec, its font and image files,
+    # stable across processes unlike version.
+    __slots__ = ('code', 'version', 'width', 'height', 'rows_per_page',
+                 'show_placeholder', 'fonts', 'fields', 'relations', 'labels', 'rects',
+                 'images', 'page_compression', 'invariant', 'output_stats', 'size_budget',
+                 'fingerprint')
+
+
+# Process wide cache of compiled plans keyed by (spec code, version stamp).
+# The version of a code is bumped by the DocumentSpec* signal handlers, they only
+# run in the process saving the spec. The other processes see the change through
+# the stamps kept in the DOCUMENT_PDF_PLAN_VERSION_CACHE cache, read at most every
+# DOCUMENT_PDF_PLAN_VERSION_TTL seconds.
+_plans = {}
+_versions = {}
+_shared = {}
+SHARED_VERSION_KEY = 'document_pdf:plan_version'
+_lock = threading.Lock()
+# SpecSource of the specs loaded from bundles by code, compiled without the database.
+_sources = {}
+
+
+# Colors of the rects and the place holder, copies with the alpha are made by
+# get_color_with_opacity.
+COLOR_MAP = MappingProxyType({
+    "red": PCMYKColor(0, 100, 100, 0),
+    "orange": PCMYKColor(0, 50, 100, 0),
+    "black": PCMYKColor(0, 0, 0, 100),
+    "blue": PCMYKColor(100, 50, 0, 0),
+    "pink": PCMYKColor(0, 100, 0, 0),
+    "purple": PCMYKColor(50, 100, 0, 0),
+    "brown": PCMYKColor(30, 60, 90, 40),
+    "green": PCMYKColor(100, 0, 100, 0),
+    "yellow": PCMYKColor(0, 0, 100, 0),
+})
+NAMED_COLORS = MappingProxyType(getAllNamedColors())
+
+
+@lru_cache(maxsize=256)
+def get_color_with_opacity(color, opacity):
+    """Returns the color of COLOR_MAP with the alpha, None for an unknown color.
+
+    The result is shared by every caller, it must not be modified.
+    """
+    color = color.lower()
+    matched_color = COLOR_MAP.get(color)
+
+    if matched_color is not None:
+        return matched_color.clone(alpha=opacity)
+    logger.warning("Color '%s' not found. Skipped.", color)
+    return None
+
+
+@lru_cache(maxsize=256)
+def resolve_rgb(color):
+    """Returns the color of a hex code or a reportlab color name, black when unknown.
+    The same color is returned for the same string, so it can be compared by identity."""
+    if color.startswith("#"):
+        return HexColor(color)
+    if color in NAMED_COLORS:
+        return NAMED_COLORS[color]
+    return HexColor("#000000")
+
+
+@lru_cache(maxsize=256)
+def resolve_style(code, font, size, color):
+    """Returns the StylePlan (font, size, rgb, ascent/descent) of a FontStyle.
+
+    The font must already be registered, the metrics come from pdfmetrics.
+    """
+    size = int(size)
+    ascent, descent = pdfmetrics.getAscentDescent(font, size)
+    return StylePlan(code=code, font=font, size=size, rgb=resolve_rgb(color),
+                     ascent=ascent, descent=descent)
+
+
+def _version_cache():
+    alias = getattr(settings, 'DOCUMENT_PDF_PLAN_VERSION_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def _shared_version(code):
+    """Returns the stamps of every spec and of the spec in the shared cache, None without it."""
+    cache = _version_cache()
+    if cache is None:
+        return None
+    now = time.monotonic()
+    cached = _shared.get(code)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    keys = (SHARED_VERSION_KEY, f'{SHARED_VERSION_KEY}:{code}')
+    values = cache.get_many(keys)
+    stamp = tuple(values.get(key) for key in keys)
+    _shared[code] = (now + getattr(settings, 'DOCUMENT_PDF_PLAN_VERSION_TTL', 1.0), stamp)
+    return stamp
+
+
+def _bump_shared_version(code=None):
+    # A new random stamp, unlike a counter it can't come back after the key is evicted.
+    cache = _version_cache()
+    if cache is not None:
+        key = SHARED_VERSION_KEY if code is None else f'{SHARED_VERSION_KEY}:{code}'
+        cache.set(key, uuid.uuid4().hex, None)
+    _shared.clear()
+
+
+def spec_version(code):
+    return _versions.get(code, 0), _shared_version(code)
+
+
+def get_layout_plan(code):
+    """Returns the compiled LayoutPlan for the spec, compiling it on the first use."""
+    key = (code, spec_version(code))
+    plan = _plans.get(key)
+    if plan is None:
+        plan = compile_layout_plan(code, key[1])
+        # A plan invalidated while it was compiled is used once but not kept.
+        if spec_version(code) == key[1]:
+            with _lock:
+                # The older plans of the spec, replaced after a change saved elsewhere.
+                for old in [old for old in _plans if old[0] == code]:
+                    del _plans[old]
+                if _versions.get(code, 0) == key[1][0]:
+                    _plans[key] = plan
+    return plan
+
+
+def invalidate_layout_plan(code=None):
+    """Drops the cached plan of the given spec code, or every plan when code is None."""
+    with _lock:
+        codes = {code} if code is not None else set(_versions) | {key[0] for key in _plans}
+        for cur in codes:
+            _versions[cur] = _versions.get(cur, 0) + 1
+        for key in [key for key in _plans if key[0] in codes]:
+            del _plans[key]
+        _shared.clear()
+    # After the commit, so other processes don't compile the plan before they can read it.
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _bump_shared_version(code))
+    else:
+        _bump_shared_version(code)
+    # A re-uploaded font can change the metrics of the styles using it.
+    resolve_style.cache_clear()
+
+
+def register_spec_source(source):
+    """Compiles the spec of source.spec.Code from source from now on, instead of the database."""
+    with _lock:
+        _sources[source.spec.Code] = source
+    invalidate_layout_plan(source.spec.Code)
+
+
+def unregister_spec_source(code=None):
+    """Reads the given spec, or every spec when code is None, from the database again."""
+    with _lock:
+        codes = [code] if code is not None else list(_sources)
+        for cur in codes:
+            _sources.pop(cur, None)
+    for cur in codes:
+        invalidate_layout_plan(cur)
+
+
+def spec_source(code):
+    """Returns the SpecSource of the spec, the registered one of a bundle or its rows in
+    the database (querysets evaluated when the plan is compiled)."""
+    source = _sources.get(code)
+    if source is not None:
+        return source
+    document_spec = DocumentSpec.objects.get(Code=code)
+    return SpecSource(
+        spec=document_spec,
+        fonts=document_spec.documentspecfonts_set.select_related('PDFFont'),
+        fields=document_spec.documentspecfields_set.select_related('Style__PDFFont'),
+        labels=document_spec.documentspeclabels_set.select_related('Style__PDFFont'),
+        rects=document_spec.documentspecrects_set.all(),
+        images=document_spec.documentspecimages_set.all())
+
+
+def _invalid_path(model, path):
+    """Returns why the dotted path can't be read from instances of model, or None."""
+    for part in path.split("."):
+        if not part:
+            return "empty attribute"
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            # Not a model field, but properties and methods are accepted.
+            if not hasattr(model, part):
+                return f"{model.__name__} has no attribute '{part}'"
+            return None
+        if not field.is_relation:
+            return None
+        model = field.related_model
+    return None
+
+
+@lru_cache(maxsize=128)
+def invalid_field_paths(plan, model):
+    """Returns the list of "field: reason" for the fields of the plan that can't be
+    read from a record of the given model. Paths past a property aren't checked."""
+    errors = []
+    for dsfield in plan.fields:
+        if dsfield.relation:
+            descriptor = getattr(model, dsfield.relation, None)
+            if descriptor is None or not hasattr(descriptor, 'field'):
+                errors.append(f"{dsfield.field}: {model.__name__} has no detail "
+                              f"'{dsfield.relation}'")
+                continue
+            reason = _invalid_path(descriptor.field.model, dsfield.path)
+        else:
+            reason = _invalid_path(model, dsfield.path)
+        if reason:
+            errors.append(f"{dsfield.field}: {reason}")
+    return errors
+
+
+def compile_layout_plan(code, version=0):
+    source = spec_source(code)
+    document_spec = source.spec
+    required_keys = ['Width', 'Height']
+    missing_keys = [key for key in required_keys if not getattr(document_spec, key)]
+    if missing_keys:
+        raise ValueError(
+            f"The document spec have missing conf: {missing_keys}")
+
+    fonts = tuple((font.PDFFont.Code, font_path(font.PDFFont))
+                  for font in source.fonts)
+    if not fonts:
+        raise AttributeError("Needs active fonts for current document")
+    register_fonts(fonts)
+
+    # The canvas page size is always set to the spec size, so translating
+    # coordinates only means inverting the Y axis.
+    height = document_spec.Height
+
+    def translateCoords(x, y, invert_Y=True):
+        return int(x), int(height - y) if invert_Y else int(y)
+
+    def compileStyle(fstyle):
+        return resolve_style(fstyle.Code, fstyle.PDFFont.Code, fstyle.Size, fstyle.Color)
+
+    fields = []
+    for dsfield in source.fields:
+        style = compileStyle(dsfield.Style)
+        x, y = translateCoords(dsfield.X, dsfield.Y)
+        alignment = dsfield.Alignment if dsfield.Width else 0
+        if alignment == 1:
+            anchor = x + int(dsfield.Width / 2)
+        elif alignment == 2:
+            anchor = x + int(dsfield.Width)
+        else:
+            anchor = x
+        if dsfield.Type == 1:  # detail
+            relation, _, path = dsfield.Field.partition(".")
+            relation = f'{relation}_set'.lower()
+        else:
+            relation, path = None, dsfield.Field
+        fields.append(FieldPlan(
+            field=dsfield.Field, type=dsfield.Type, relation=relation, path=path,
+            accessor=attrgetter(path), x=x,
+            y=y - (style.ascent - style.descent), anchor=anchor,
+            alignment=alignment, width=dsfield.Width,
+            text_limit=dsfield.TextLimit, decimals=dsfield.Decimals, style=style))
+
+    labels = []
+    for dslabel in source.labels:
+        style = compileStyle(dslabel.Style)
+        x, y = translateCoords(dslabel.X, dslabel.Y)
+        labels.append(LabelPlan(
+            text=dslabel.Text, x=x, y=y - (style.ascent - style.descent),
+            alignment=dslabel.Alignment, style=style))
+
+    rects = []
+    for dsrect in source.rects:
+        if not dsrect.Show:
+            continue
+        if dsrect.Rounded and not dsrect.Radius:
+            raise AttributeError("Needs define radius for rounded rects")
+        bx, by = translateCoords(dsrect.X, dsrect.Y)
+        ex, ey = translateCoords(dsrect.X + dsrect.Width, dsrect.Y + dsrect.Height)
+        rects.append(RectPlan(
+            x=bx, y=by, width=ex - bx, height=ey - by,
+            rounded=dsrect.Rounded, radius=dsrect.Radius,
+            fill=dsrect.Fill,
+            fill_color=get_color_with_opacity(
+                dsrect.FillColor, dsrect.FillColorAlpha) if dsrect.Fill else None,
+            stroke=dsrect.Stroke,
+            stroke_color=get_color_with_opacity(
+                dsrect.StrokeColor, dsrect.StrokeColorAlpha) if dsrect.Stroke else None))
+
+    images = []
+    for dsimage in source.images:
+        x, y = translateCoords(dsimage.X, dsimage.Y)
+        h = int(dsimage.Height)
+        images.append(ImagePlan(
+            filename=f'media/{dsimage.Filename}', x=x, y=y - h,
+            width=int(dsimage.Width), height=h, watermark=dsimage.Watermark,
+            opacity=float(dsimage.WatermarkOpacity) if dsimage.Watermark else 1))
+
+    content = dict(
+        code=code, width=document_spec.Width, height=height,
+        rows_per_page=document_spec.RowsPerPage,
+        show_placeholder=document_spec.ShowPlaceHolder, fonts=fonts,
+        fields=tuple(fields),
+        relations=tuple(dict.fromkeys(f.relation for f in fields if f.relation)),
+        labels=tuple(labels), rects=tuple(rects),
+        images=tuple(images), page_compression=document_spec.PageCompression,
+        invariant=document_spec.Invariant, output_stats=document_spec.OutputStats,
+        size_budget=document_spec.SizeBudget)
+    return LayoutPlan(version=version, fingerprint=plan_fingerprint(content), **content)
+
+
+def _file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def plan_fingerprint(content):
+    """Returns the sha256 of the plan content, font files by digest and image files by
+    mtime and size, so a re-uploaded file gives a new fingerprint."""
+    digest = hashlib.sha256(repr(sorted(content.items())).encode())
+    for _, path in content['fonts']:
+        digest.update(font_digest(path).encode())
+    for image in content['images']:
+        digest.update(repr(_file_state(image.filename)).encode())
+    return digest.hexdigest()
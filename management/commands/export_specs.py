@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...bundles import bundle_format, export_specs, write_bundle
+from ...models import DocumentSpec
+
+
+class Command(BaseCommand):
+    help = ("Exports document specs with their fields, labels, rects, images, fonts and "
+            "styles to a bundle file (.json, or .msgpack with the msgpack package).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('codes', nargs='*', help="Codes of the specs, all of them by default.")
+        parser.add_argument('--output', required=True, help="Bundle file to write.")
+
+    def handle(self, *args, codes, output, **options):
+        try:
+            bundle_format(output)
+            bundle = export_specs(codes or None)
+            write_bundle(bundle, output)
+        except (ValueError, DocumentSpec.DoesNotExist) as e:
+            raise CommandError(e)
+        self.stdout.write(f"Exported {len(bundle['specs'])} document specs to {output}")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...bundles import bundle_paths, import_bundle, read_bundle
+
+
+class Command(BaseCommand):
+    help = ("Imports the document specs of bundle files into the database, the specs "
+            "with the same code are replaced.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+',
+                            help="Bundle files, or directories of bundle files.")
+
+    def handle(self, *args, paths, **options):
+        for path in bundle_paths(paths):
+            try:
+                codes = import_bundle(read_bundle(path))
+            except (OSError, ValueError) as e:
+                raise CommandError(f"{path}: {e}")
+            self.stdout.write(f"Imported {', '.join(codes)} from {path}")
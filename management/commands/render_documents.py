@@ -0,0 +1,148 @@
+import os
+import time
+from functools import partial
+from itertools import islice
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from ...batch import prefetch_details
+from ...document_wrapper import DocumentPDF
+from ...layout import get_layout_plan
+from ...models import DocumentSpec
+from ...parallel import _render_chunk, get_process_executor
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = ("Renders a document spec for every record of a model matching the filters, "
+            "or listed in a file of primary keys.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('spec', help="Code of the document spec.")
+        parser.add_argument('model', help="Model of the records, as app_label.ModelName.")
+        parser.add_argument('--filter', action='append', default=[], metavar='LOOKUP=VALUE',
+                            help="Queryset filter, e.g. --filter Date__year=2024. Repeatable.")
+        parser.add_argument('--pks-file', help="File with a primary key per line.")
+        parser.add_argument('--output', default='{pk}.pdf',
+                            help="Filename per record, formatted with {pk} and {record}, "
+                                 "or the single PDF with --combine. Default: {pk}.pdf")
+        parser.add_argument('--combine', action='store_true',
+                            help="Append every document to a single PDF.")
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Records fetched (and prefetched) per query.")
+        parser.add_argument('--workers', type=int, default=0,
+                            help="Worker processes, 0 renders in this process.")
+        parser.add_argument('--checkpoint',
+                            help="File of the rendered primary keys, they are skipped when "
+                                 "the command runs again.")
+
+    def handle(self, *args, spec, model, **options):
+        try:
+            model = apps.get_model(model)
+        except (LookupError, ValueError):
+            raise CommandError(f"Model {model} not found")
+        try:
+            plan = get_layout_plan(spec)
+        except DocumentSpec.DoesNotExist:
+            raise CommandError(f"Document Spec {spec} not found")
+        if options['combine'] and (options['workers'] or options['checkpoint']):
+            raise CommandError("--combine can't be used with --workers or --checkpoint")
+
+        done = set()
+        if options['checkpoint'] and os.path.exists(options['checkpoint']):
+            with open(options['checkpoint']) as f:
+                done = {line.strip() for line in f if line.strip()}
+        pks, total, skipped = self.selectPks(model, options, done)
+        pks = (pk for pk in pks if str(pk) not in done)
+        if skipped:
+            self.stdout.write(f"Skipping {skipped} documents already rendered")
+            total -= skipped
+
+        checkpoint = open(options['checkpoint'], 'a') if options['checkpoint'] else None
+        executor = None
+        if options['workers']:
+            # One pool for the whole run, each worker loads the spec and its fonts once.
+            # The workers aren't forked, the primary keys are still being read through
+            # a cursor of this process (server side on PostgreSQL).
+            executor = get_process_executor(spec, options['workers'])
+        start = time.perf_counter()
+        count = 0
+        try:
+            if executor is not None:
+                render = partial(_render_chunk, spec, model._meta.label, options['output'])
+                per_worker = max(1, options['chunk_size'] // options['workers'])
+                for chunk in chunked(pks, options['chunk_size']):
+                    parts = list(chunked(chunk, per_worker))
+                    outputs = [item for part in executor.map(render, parts) for item in part]
+                    rendered = [pk for pk, item in zip(chunk, outputs) if item is not None]
+                    count += len(rendered)
+                    self.chunkDone(rendered, checkpoint, count, total, start)
+            else:
+                count = self.renderInline(spec, plan, model, pks, options, checkpoint, total, start)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if checkpoint is not None:
+                checkpoint.close()
+        seconds = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Rendered {count} documents in {seconds:.1f}s "
+            f"({count / seconds if seconds else 0:.1f} docs/sec)"))
+
+    def selectPks(self, model, options, done):
+        """Returns an iterator over the primary keys to render, their count and how many
+        of them are in done (the checkpoint may have others)."""
+        if options['pks_file']:
+            with open(options['pks_file']) as f:
+                pks = [line.strip() for line in f if line.strip()]
+            return iter(pks), len(pks), sum(1 for pk in pks if pk in done)
+        filters = {}
+        for item in options['filter']:
+            lookup, sep, value = item.partition('=')
+            if not sep:
+                raise CommandError(f"Invalid filter {item}, expected LOOKUP=VALUE")
+            filters[lookup] = value
+        queryset = model._default_manager.filter(**filters).order_by('pk')
+        skipped = sum(queryset.filter(pk__in=chunk).count()
+                      for chunk in chunked(sorted(done), options['chunk_size']))
+        return (queryset.values_list('pk', flat=True).iterator(chunk_size=options['chunk_size']),
+                queryset.count(), skipped)
+
+    def renderInline(self, spec, plan, model, pks, options, checkpoint, total, start):
+        output = options['output']
+        curCanvas = None
+        count = 0
+        for chunk in chunked(pks, options['chunk_size']):
+            records = prefetch_details(model._default_manager.filter(pk__in=chunk), plan,
+                                       options['chunk_size'])
+            # In the order of the primary keys, the one of --pks-file for a combined PDF.
+            position = {str(pk): idx for idx, pk in enumerate(chunk)}
+            records = sorted(records, key=lambda record: position[str(record.pk)])
+            rendered = []
+            for record in records:
+                if options['combine']:
+                    doc = DocumentPDF(spec, output, record)
+                    if curCanvas is None:
+                        curCanvas = doc.createCanvas(output)
+                    doc.generatePDF(curCanvas=curCanvas)
+                else:
+                    DocumentPDF(spec, output.format(pk=record.pk, record=record),
+                                record).generatePDF()
+                rendered.append(record.pk)
+            count += len(rendered)
+            self.chunkDone(rendered, checkpoint, count, total, start)
+        if curCanvas is not None:
+            curCanvas.save()
+        return count
+
+    def chunkDone(self, pks, checkpoint, count, total, start):
+        if checkpoint is not None:
+            checkpoint.writelines(f"{pk}\n" for pk in pks)
+            checkpoint.flush()
+        seconds = time.perf_counter() - start
+        self.stdout.write(
+            f"{count}/{total} documents ({count / seconds if seconds else 0:.1f} docs/sec)")
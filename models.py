@@ -55,6 +55,16 @@ class DocumentSpec(models.Model):
     RowsPerPage = models.BigIntegerField(null=True)
     ShowPlaceHolder = models.BooleanField(
         default=False, help_text="The expected attribute is displayed in case it is not found.")
+    PageCompression = models.BooleanField(
+        null=True, blank=True,
+        help_text="Compress the page contents, the reportlab default when not set.")
+    Invariant = models.BooleanField(
+        default=False, help_text="Same bytes for the same content, without creation dates or ids.")
+    OutputStats = models.BooleanField(
+        default=False,
+        help_text="Break the size of each document down into fonts, images and contents.")
+    SizeBudget = models.PositiveIntegerField(
+        null=True, blank=True, help_text="Bytes, a warning is logged for bigger documents.")
 
     no_admin = True
 
@@ -0,0 +1,287 @@
+from array import array
+from functools import lru_cache
+from reportlab.lib.colors import black, lightgrey
+from .images import draw_cached_image
+from .text_utils import latin1_to_ascii, string_width
+
+# Op codes and the numbers each one takes from DrawOps.numbers. Strings (texts,
+# fonts, filenames) and colors are stored once in their tables and referenced
+# by index, an alpha of -1 means the alpha of the color.
+TEXT = 0          # x, y, text
+FILL_RGB = 1      # red, green, blue
+FILL_COLOR = 2    # color, alpha
+STROKE_COLOR = 3  # color
+FONT = 4          # font, size
+RECT = 5          # x, y, width, height
+ROUND_RECT = 6    # x, y, width, height, radius, fill, stroke
+IMAGE = 7         # filename, x, y, width, height
+STATIC = 8        # layer
+PAGE = 9
+
+NAMES = ('text', 'fill_rgb', 'fill_color', 'stroke_color', 'font', 'rect', 'round_rect',
+         'image', 'static', 'page')
+ARITY = (3, 3, 2, 1, 2, 4, 7, 5, 1, 0)
+# Which numbers of each op are indexes in the strings / colors tables.
+STRING_ARGS = {TEXT: (2,), FONT: (0,), IMAGE: (0,)}
+COLOR_ARGS = {FILL_COLOR: (0,), STROKE_COLOR: (0,)}
+DRAW_OPS = (TEXT, RECT, ROUND_RECT, IMAGE)
+
+# Layers of STATIC, the form XObjects of the spec drawn under and over the fields.
+BACKGROUND = 0
+FOREGROUND = 1
+
+LEFT = 0
+CENTER = 1
+RIGHT = 2
+
+
+class DrawOps:
+    """A compact list of resolved draw operations, built by OpsBuilder and drawn by
+    execute_ops. It is picklable, can be cached or sent to other processes, and
+    compares equal to the same list of ops, iterate it for readable tuples.
+
+    layers holds the ops of the BACKGROUND and FOREGROUND layers stamped by STATIC,
+    a tuple of DrawOps drawn in order for each one, None without STATIC ops.
+    """
+    __slots__ = ('codes', 'numbers', 'strings', 'colors', 'draw_calls', 'layers')
+
+    def __init__(self, codes, numbers, strings, colors, draw_calls, layers=None):
+        self.codes = codes
+        self.numbers = numbers
+        self.strings = strings
+        self.colors = colors
+        self.draw_calls = draw_calls
+        self.layers = layers
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        """Yields each op as a tuple (name, *args) with the strings and colors resolved."""
+        pos = 0
+        for code in self.codes:
+            args = list(self.numbers[pos:pos + ARITY[code]])
+            pos += ARITY[code]
+            for idx in STRING_ARGS.get(code, ()):
+                args[idx] = self.strings[int(args[idx])]
+            for idx in COLOR_ARGS.get(code, ()):
+                args[idx] = self.colors[int(args[idx])]
+            yield (NAMES[code], *args)
+
+    def __eq__(self, other):
+        if not isinstance(other, DrawOps):
+            return NotImplemented
+        return list(self) == list(other) and self.layers == other.layers
+
+    def __repr__(self):
+        return f"DrawOps({len(self)} ops, {self.draw_calls} draw calls)"
+
+
+class OpsBuilder:
+    """Appends ops to the arrays of a DrawOps.
+
+    Fill color and font changes that don't change the canvas state are skipped.
+    A page resets the state, as a new canvas page does.
+    """
+
+    def __init__(self):
+        self.codes = array('B')
+        self.numbers = array('d')
+        self.strings = []
+        self.colors = []
+        self.draw_calls = 0
+        self._stringIdx = {}
+        self._colorIdx = {}
+        self._fill = None
+        self._font = None
+
+    def _string(self, value):
+        idx = self._stringIdx.get(value)
+        if idx is None:
+            idx = self._stringIdx[value] = len(self.strings)
+            self.strings.append(value)
+        return idx
+
+    def _color(self, color):
+        # reportlab colors are not hashable, the table keeps them alive for id().
+        idx = self._colorIdx.get(id(color))
+        if idx is None:
+            idx = self._colorIdx[id(color)] = len(self.colors)
+            self.colors.append(color)
+        return idx
+
+    def _op(self, code, *numbers):
+        self.codes.append(code)
+        self.numbers.extend(numbers)
+
+    def style(self, fstyle):
+        """Sets the fill color and the font of a StylePlan."""
+        if fstyle.rgb is not self._fill:
+            rgb = self._fill = fstyle.rgb
+            self._op(FILL_RGB, rgb.red, rgb.green, rgb.blue)
+        if (fstyle.font, fstyle.size) != self._font:
+            self._font = (fstyle.font, fstyle.size)
+            self._op(FONT, self._string(fstyle.font), fstyle.size)
+
+    def fill_color(self, color, alpha=None):
+        self._fill = None
+        self._op(FILL_COLOR, self._color(color), -1 if alpha is None else alpha)
+
+    def stroke_color(self, color):
+        self._op(STROKE_COLOR, self._color(color))
+
+    def text(self, x, y, value, alignment=LEFT):
+        """Draws value with the current font, x is the anchor of the alignment."""
+        if alignment != LEFT and self._font is not None:
+            width = string_width(value, *self._font)
+            x -= width / 2 if alignment == CENTER else width
+        self.draw_calls += 1
+        self._op(TEXT, x, y, self._string(value))
+
+    def rect(self, x, y, width, height):
+        self.draw_calls += 1
+        self._op(RECT, x, y, width, height)
+
+    def round_rect(self, x, y, width, height, radius, fill, stroke):
+        self.draw_calls += 1
+        self._op(ROUND_RECT, x, y, width, height, radius, fill, stroke)
+
+    def image(self, filename, x, y, width, height):
+        self.draw_calls += 1
+        self._op(IMAGE, self._string(filename), x, y, width, height)
+
+    def static(self, layer):
+        self._op(STATIC, layer)
+
+    def page(self):
+        self._fill = self._font = None
+        self._op(PAGE)
+
+    def build(self, layers=None):
+        return DrawOps(self.codes, self.numbers, self.strings, self.colors, self.draw_calls,
+                       layers)
+
+
+def _text_line(text, x, y, value):
+    try:
+        text.textLine(value)
+    except UnicodeDecodeError:
+        value = latin1_to_ascii(value)
+        text.setTextOrigin(x, y)
+        try:
+            text.textLine(value)
+        except UnicodeDecodeError:
+            text.setTextOrigin(x, y)
+            text.textLine(repr(value))
+
+
+def layer_forms(curCanvas, layers):
+    """Returns the names of the form XObjects of the layers on the canvas, None for an
+    empty layer. Each one is drawn on the first use and then reused by every page."""
+    drawn = curCanvas.__dict__.setdefault('_ddp_layer_forms', [])
+    names = []
+    for layer in layers:
+        name = None
+        if any(layer):
+            # By identity, DrawOps aren't hashable, the list keeps them alive.
+            name = next((cur for ops, cur in drawn if ops is layer), None)
+            if name is None:
+                name = f'ddplayer{len(drawn)}'
+                curCanvas.beginForm(name)
+                for ops in layer:
+                    execute_ops(ops, curCanvas)
+                curCanvas.endForm()
+                drawn.append((layer, name))
+        names.append(name)
+    return tuple(names)
+
+
+def execute_ops(ops, curCanvas, forms=None):
+    """Draws the ops on the canvas, forms are the names of the BACKGROUND and
+    FOREGROUND form XObjects stamped by STATIC, None for an empty layer. By default
+    they are drawn on the canvas from the layers of the ops.
+
+    Consecutive texts share a single text object, with their fill color and font
+    changes inside it, instead of a BT/ET block and a font selection per string.
+    """
+    numbers = ops.numbers
+    strings = ops.strings
+    colors = ops.colors
+    text = None
+    font = None
+    pos = 0
+    for code in ops.codes:
+        if code == TEXT:
+            x, y = numbers[pos], numbers[pos + 1]
+            if text is None:
+                text = curCanvas.beginText(x, y)
+                if font is not None:
+                    text.setFont(*font)
+            else:
+                text.setTextOrigin(x, y)
+            _text_line(text, x, y, strings[int(numbers[pos + 2])])
+        elif code == FILL_RGB:
+            (text or curCanvas).setFillColorRGB(numbers[pos], numbers[pos + 1], numbers[pos + 2])
+        elif code == FONT:
+            font = (strings[int(numbers[pos])], numbers[pos + 1])
+            if text is not None:
+                text.setFont(*font)
+        else:
+            if text is not None:
+                curCanvas.drawText(text)
+                text = None
+            if code == FILL_COLOR:
+                alpha = numbers[pos + 1]
+                curCanvas.setFillColor(colors[int(numbers[pos])],
+                                       alpha=None if alpha < 0 else alpha)
+            elif code == STROKE_COLOR:
+                curCanvas.setStrokeColor(colors[int(numbers[pos])])
+            elif code == RECT:
+                curCanvas.rect(*numbers[pos:pos + 4])
+            elif code == ROUND_RECT:
+                x, y, width, height, radius, fill, stroke = numbers[pos:pos + 7]
+                curCanvas.roundRect(x, y, width, height, radius, fill=int(fill), stroke=int(stroke))
+            elif code == IMAGE:
+                draw_cached_image(curCanvas, strings[int(numbers[pos])], *numbers[pos + 1:pos + 5])
+            elif code == STATIC:
+                if forms is None:
+                    if ops.layers is None:
+                        raise ValueError("STATIC ops need the forms or the layers of the ops")
+                    forms = layer_forms(curCanvas, ops.layers)
+                name = forms[int(numbers[pos])]
+                if name:
+                    curCanvas.doForm(name)
+            elif code == PAGE:
+                curCanvas.showPage()
+        pos += ARITY[code]
+    if text is not None:
+        curCanvas.drawText(text)
+
+
+@lru_cache(maxsize=64)
+def static_ops(plan):
+    """Returns the (images, labels, rects) ops of a plan, they don't depend on the record."""
+    images = OpsBuilder()
+    for dsimage in plan.images:
+        if dsimage.watermark:
+            images.fill_color(lightgrey, dsimage.opacity)
+        images.image(dsimage.filename, dsimage.x, dsimage.y, dsimage.width, dsimage.height)
+
+    labels = OpsBuilder()
+    for dslabel in plan.labels:
+        labels.style(dslabel.style)
+        labels.text(dslabel.x, dslabel.y, dslabel.text)
+
+    rects = OpsBuilder()
+    for dsrect in plan.rects:
+        if not dsrect.rounded:
+            rects.rect(dsrect.x, dsrect.y, dsrect.width, dsrect.height)
+        else:
+            if dsrect.fill:
+                rects.fill_color(dsrect.fill_color)
+            if dsrect.stroke:
+                rects.stroke_color(dsrect.stroke_color)
+            rects.round_rect(dsrect.x, dsrect.y, dsrect.width, dsrect.height, 10,
+                             dsrect.fill, dsrect.stroke)
+            rects.fill_color(black, 1)
+    return images.build(), labels.build(), rects.build()
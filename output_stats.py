@@ -0,0 +1,81 @@
+import re
+
+_PAGE = re.compile(rb'/Type /Page\b(?!s)')
+_FONT = re.compile(rb'/Type /Font\b')
+_CONTENTS = re.compile(rb'/Contents (\d+) 0 R')
+_FONT_REFS = re.compile(rb'/(?:FontDescriptor|ToUnicode) (\d+) 0 R')
+_FONT_FILE = re.compile(rb'/FontFile\d? (\d+) 0 R')
+_BASE_FONT = re.compile(rb'/BaseFont /([^\s/\[<>]+)')
+_CHARS = re.compile(rb'/FirstChar (\d+).*?/LastChar (\d+)', re.S)
+_SUBSET_TAG = re.compile(r'^[A-Z]{6}\+')
+# The keyword only, font names like BitstreamVera contain it too.
+_STREAM = re.compile(rb'\bstream\r?\n')
+
+
+def _object_spans(data):
+    """Returns {object number: (start, end)} read from the cross-reference table."""
+    xref = int(data[data.rindex(b'startxref') + 9:].split()[0])
+    tokens = data[xref:data.index(b'trailer', xref)].split()[1:]
+    offsets = {}
+    pos = 0
+    while pos < len(tokens):
+        first, count = int(tokens[pos]), int(tokens[pos + 1])
+        pos += 2
+        for number in range(first, first + count):
+            offset, _, kind = tokens[pos:pos + 3]
+            pos += 3
+            if kind == b'n':
+                offsets[number] = int(offset)
+    ends = sorted(offsets.values()) + [xref]
+    end_of = dict(zip(ends, ends[1:]))
+    return {number: (offset, end_of[offset]) for number, offset in offsets.items()}
+
+
+def output_breakdown(data):
+    """Breaks the bytes of a PDF written by reportlab down into fonts (with their
+    descriptors, files and unicode maps), images, content (pages and forms) and
+    other (catalog, page tree, cross-reference...).
+
+    'embedded_fonts' has the subsets, glyphs and bytes of each embedded font.
+    """
+    spans = _object_spans(data)
+    sizes = {number: end - start for number, (start, end) in spans.items()}
+    heads = {}
+    for number, (start, end) in spans.items():
+        head = data[start:end]
+        stream = _STREAM.search(head)
+        heads[number] = head[:stream.start()] if stream else head
+
+    parts = {}
+    embedded = {}
+    for number, head in heads.items():
+        if b'/Subtype /Image' in head:
+            parts[number] = 'images'
+        elif b'/Subtype /Form' in head:
+            parts[number] = 'content'
+        elif _PAGE.search(head):
+            for ref in _CONTENTS.findall(head):
+                parts[int(ref)] = 'content'
+        elif _FONT.search(head):
+            members = {number}
+            for ref in _FONT_REFS.findall(head):
+                members.add(int(ref))
+                members.update(int(ref) for ref in _FONT_FILE.findall(heads.get(int(ref), b'')))
+            parts.update(dict.fromkeys(members, 'fonts'))
+            base_font = _BASE_FONT.search(head)
+            if not base_font or not any(_FONT_FILE.search(heads.get(ref, b'')) for ref in members):
+                continue
+            name = _SUBSET_TAG.sub('', base_font.group(1).decode('latin-1'))
+            font = embedded.setdefault(name, {'subsets': 0, 'glyphs': 0, 'bytes': 0})
+            font['subsets'] += 1
+            chars = _CHARS.search(head)
+            if chars:
+                font['glyphs'] += int(chars.group(2)) - int(chars.group(1)) + 1
+            font['bytes'] += sum(sizes.get(ref, 0) for ref in members)
+
+    breakdown = dict.fromkeys(('fonts', 'images', 'content'), 0)
+    for number, part in parts.items():
+        breakdown[part] += sizes.get(number, 0)
+    breakdown['other'] = len(data) - sum(breakdown.values())
+    breakdown['embedded_fonts'] = embedded
+    return breakdown
@@ -0,0 +1,131 @@
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+# This module is imported by spawned workers before Django is set up, so the
+# models and the renderer are only imported inside the functions.
+
+
+# Inherited database connections of a forked worker, kept referenced because closing
+# them, even when garbage collected, would end the session of the parent.
+_inherited = []
+
+
+def _init_worker(spec_code):
+    import django
+    from django.apps import apps
+    from django.db import connections
+    if not apps.ready:
+        django.setup()
+    for conn in connections.all():
+        # A forked worker must not use the parent sockets, an in-memory SQLite
+        # database only exists through the inherited connection.
+        if conn.connection is None or (conn.vendor == 'sqlite' and conn.is_in_memory_db()):
+            continue
+        _inherited.append(conn.connection)
+        conn.connection = None
+    from .layout import get_layout_plan
+    # Compiling the plan registers the spec fonts once per worker.
+    get_layout_plan(spec_code)
+
+
+def pool_context(mp_context=None):
+    """Returns the multiprocessing context of a worker pool.
+
+    The default is forkserver (spawn where it isn't available), the workers start
+    without the database connections of the caller and set Django up from
+    DJANGO_SETTINGS_MODULE. With a fork context the connections of the caller are
+    closed before the workers are forked, which can't be done inside a transaction.
+    """
+    import multiprocessing
+    from django.db import connections
+    if mp_context is None:
+        methods = multiprocessing.get_all_start_methods()
+        return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    if isinstance(mp_context, str):
+        mp_context = multiprocessing.get_context(mp_context)
+    if mp_context.get_start_method() == 'fork':
+        for conn in connections.all():
+            if conn.vendor == 'sqlite' and conn.is_in_memory_db():
+                continue
+            if conn.in_atomic_block:
+                raise ValueError("Workers can't be forked inside a transaction of the "
+                                 f"'{conn.alias}' database, use a spawn or forkserver context")
+            conn.close()
+    return mp_context
+
+
+class RenderProcessPool(ProcessPoolExecutor):
+    """A process pool built by get_process_executor."""
+
+
+def get_process_executor(spec_code, workers=None, mp_context=None):
+    """Returns a process pool for the renders of the spec, the only kind of process pool
+    supported by render_parallel, render_documents and agenerate_pdf.
+
+    Its workers are started through pool_context, set Django up and load the spec and
+    its fonts once. Shut it down (or use it as a context manager) when done.
+    """
+    return RenderProcessPool(max_workers=workers or os.cpu_count(),
+                             mp_context=pool_context(mp_context),
+                             initializer=_init_worker, initargs=(spec_code,))
+
+
+def _render_chunk(spec_code, model_label, output, pks, document_class=None):
+    from django.apps import apps
+    from .batch import prefetch_details
+    from .document_wrapper import DocumentPDF
+    from .layout import get_layout_plan
+
+    document_class = document_class or DocumentPDF
+
+    plan = get_layout_plan(spec_code)
+    model = apps.get_model(model_label)
+    records = prefetch_details(model._default_manager.filter(pk__in=pks), plan,
+                               chunk_size=len(pks))
+    rendered = {}
+    for record in records:
+        if output is None:
+            buffer = io.BytesIO()
+            doc = document_class(spec_code, buffer, record)
+            curCanvas = doc.createCanvas(buffer)
+            doc.generatePDF(curCanvas=curCanvas)
+            curCanvas.save()
+            rendered[record.pk] = buffer.getvalue()
+        else:
+            filename = output.format(pk=record.pk, record=record)
+            document_class(spec_code, filename, record).generatePDF()
+            rendered[record.pk] = filename
+    return [rendered.get(pk) for pk in pks]
+
+
+def render_parallel(spec_code, model, pks, output=None, workers=None, chunk_size=50,
+                    mp_context=None):
+    """Renders the spec for the records of `model` with the given pks in a process pool.
+
+    Workers load the spec and its fonts once in their initializer and only
+    receive primary keys. With output=None the PDFs are returned as bytes,
+    otherwise `output` is a format string such as "invoices/{pk}.pdf" and the
+    filenames are returned. Results follow the order of `pks`, a pk without
+    record gives None. workers=0 renders in the current process.
+    workers and mp_context are passed to get_process_executor.
+    """
+    from django.db.models import Model
+    from .batch import BatchResult
+
+    model_label = model._meta.label if isinstance(model, type) and issubclass(
+        model, Model) else model
+    pks = list(pks)
+    chunks = [pks[idx:idx + chunk_size] for idx in range(0, len(pks), chunk_size)]
+    render = partial(_render_chunk, spec_code, model_label, output)
+    start = time.perf_counter()
+    if workers == 0:
+        results = map(render, chunks)
+        outputs = [item for chunk in results for item in chunk]
+    else:
+        with get_process_executor(spec_code, workers, mp_context) as executor:
+            outputs = [item for chunk in executor.map(render, chunks) for item in chunk]
+    return BatchResult(sum(1 for item in outputs if item is not None),
+                       time.perf_counter() - start, outputs)
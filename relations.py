@@ -0,0 +1,156 @@
+from collections import OrderedDict
+from functools import lru_cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch, prefetch_related_objects
+from .layout import get_layout_plan
+
+
+class RelationCache:
+    """Rows of the detail relations of records, keyed by (model, pk, relation).
+
+    Each relation is evaluated once. A DocumentPDF creates its own unbounded
+    cache, batch jobs can share one with max_size, the least recently used
+    relations are evicted beyond it. hits and misses count the lookups.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def rows(self, record, relation):
+        """Returns the list of rows of record.<relation>, [] when it doesn't exist."""
+        key = (type(record), record.pk, relation)
+        if key in self._rows:
+            self.hits += 1
+            self._rows.move_to_end(key)
+            return self._rows[key]
+        self.misses += 1
+        manager = getattr(record, relation, None)
+        # Going through .all() reuses the rows of prefetch_related.
+        rows = list(manager.all()) if manager is not None else []
+        self._rows[key] = rows
+        if self.max_size is not None and len(self._rows) > self.max_size:
+            self._rows.popitem(last=False)
+        return rows
+
+    def clear(self):
+        self._rows.clear()
+
+
+def _select_related_lookup(model, path):
+    """Returns the select_related lookup of the leading FK hops of a dotted path."""
+    hops = []
+    for part in path.split(".")[:-1]:
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            break
+        if not (field.many_to_one or field.one_to_one):
+            break
+        hops.append(part)
+        model = field.related_model
+    return "__".join(hops)
+
+
+def values_lookup(model, path):
+    """Returns the values_list lookup of a dotted path of model fields ending on a
+    non-relation field, None when it can't be read by values_list (a property, a
+    method, a relation whose instance is printed...).
+
+    A relation that may be missing (nullable or reverse) is None too, values_list
+    would give None where the instance path leaves the cell blank."""
+    parts = path.split(".")
+    for part in parts[:-1]:
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            return None
+        if not (field.many_to_one or field.one_to_one) or field.null or not field.concrete:
+            return None
+        model = field.related_model
+    try:
+        field = model._meta.get_field(parts[-1])
+    except FieldDoesNotExist:
+        return None
+    if field.is_relation or not field.concrete:
+        return None
+    return "__".join(parts)
+
+
+@lru_cache(maxsize=128)
+def query_lookups(plan, model):
+    """Works out the lookups needed to read every field of the plan from a record of model.
+
+    Returns (select_related lookups, ((detail relation, row model, row select_related
+    lookups), ...)). Relations and hops that aren't model fields are left out.
+    """
+    select = set()
+    details = {}
+    for dsfield in plan.fields:
+        if dsfield.relation:
+            descriptor = getattr(model, dsfield.relation, None)
+            if descriptor is None or not hasattr(descriptor, 'field'):
+                continue
+            row_model = descriptor.field.model
+            lookups = details.setdefault(dsfield.relation, (row_model, set()))[1]
+            lookup = _select_related_lookup(row_model, dsfield.path)
+        else:
+            lookups = select
+            lookup = _select_related_lookup(model, dsfield.path)
+        if lookup:
+            lookups.add(lookup)
+    return (tuple(sorted(select)),
+            tuple((relation, row_model, tuple(sorted(lookups)))
+                  for relation, (row_model, lookups) in details.items()))
+
+
+def _plan(plan):
+    return get_layout_plan(plan) if isinstance(plan, str) else plan
+
+
+def detail_prefetches(plan, model):
+    """Returns the Prefetch objects of the detail relations, rows come with their FKs joined."""
+    _, details = query_lookups(_plan(plan), model)
+    return [Prefetch(relation, queryset=row_model._default_manager.select_related(*lookups))
+            for relation, row_model, lookups in details]
+
+
+def detail_queryset(plan, record, relation):
+    """Returns the queryset of the rows of a detail relation of record, with the FKs
+    read by the spec joined, None when the record doesn't have the relation."""
+    manager = getattr(record, relation, None)
+    if manager is None:
+        return None
+    _, details = query_lookups(_plan(plan), type(record))
+    lookups = next((lookups for name, _, lookups in details if name == relation), ())
+    return manager.all().select_related(*lookups)
+
+
+def prepare_queryset(plan, queryset):
+    """Applies the select_related/prefetch_related lookups of the spec (a plan or a
+    spec code) to a queryset of records, so rendering runs a constant number of queries."""
+    plan = _plan(plan)
+    select, _ = query_lookups(plan, queryset.model)
+    return queryset.select_related(*select).prefetch_related(
+        *detail_prefetches(plan, queryset.model))
+
+
+def prefetch_records(plan, records):
+    """Same as prepare_queryset for a list of already loaded records."""
+    if records:
+        plan = _plan(plan)
+        model = type(records[0])
+        select, _ = query_lookups(plan, model)
+        prefetch_related_objects(records, *select, *detail_prefetches(plan, model))
+    return records
+
+
+def refetch_record(plan, record):
+    """Loads the record again with the lookups of the spec applied, before rendering."""
+    queryset = type(record)._default_manager.filter(pk=record.pk)
+    return prepare_queryset(plan, queryset).get()
@@ -0,0 +1,133 @@
+import os
+import threading
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.files.base import ContentFile
+from django.utils.module_loading import import_string
+
+
+class DiskResultCache:
+    """Rendered PDFs stored as files of `directory`.
+
+    Reading a document marks it as recently used, beyond max_bytes the least
+    recently used ones are deleted. Several processes can share the directory.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.pdf')
+
+    def _entries(self):
+        with os.scandir(self.directory) as entries:
+            return [entry for entry in entries if entry.name.endswith('.pdf')]
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def set(self, key, data):
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self.size is None:
+                self.size = sum(entry.stat().st_size for entry in self._entries())
+            else:
+                self.size += len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(((entry.stat(), entry.path) for entry in self._entries()),
+                         key=lambda item: item[0].st_mtime_ns)
+        self.size = sum(stat.st_size for stat, _ in entries)
+        for stat, path in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= stat.st_size
+
+    def clear(self):
+        with self._lock:
+            for entry in self._entries():
+                os.remove(entry.path)
+            self.size = 0
+
+
+class DjangoCacheResultCache:
+    """Rendered PDFs stored in a Django cache backend, evicted by the backend."""
+
+    def __init__(self, alias=DEFAULT_CACHE_ALIAS, timeout=DEFAULT_TIMEOUT, prefix='document_pdf'):
+        self.alias = alias
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def get(self, key):
+        return caches[self.alias].get(f'{self.prefix}:{key}')
+
+    def set(self, key, data):
+        caches[self.alias].set(f'{self.prefix}:{key}', data, self.timeout)
+
+
+class StorageResultCache:
+    """Rendered PDFs stored as files of a Django storage, the default storage when none
+    is given. Nothing is evicted, the storage is expected to expire old files."""
+
+    def __init__(self, storage=None, prefix='document_pdf'):
+        if storage is None:
+            from django.core.files.storage import default_storage as storage
+        self.storage = storage
+        self.prefix = prefix
+
+    def _name(self, key):
+        return f'{self.prefix}/{key}.pdf'
+
+    def get(self, key):
+        name = self._name(key)
+        if not self.storage.exists(name):
+            return None
+        with self.storage.open(name, 'rb') as f:
+            return f.read()
+
+    def set(self, key, data):
+        name = self._name(key)
+        if not self.storage.exists(name):
+            self.storage.save(name, ContentFile(data))
+
+
+_cache = None
+_config = None
+
+
+def get_result_cache():
+    """Returns the cache of the DOCUMENT_PDF_RESULT_CACHE setting, None when it isn't set:
+
+        DOCUMENT_PDF_RESULT_CACHE = {
+            'BACKEND': 'django_document_pdf.result_cache.DiskResultCache',
+            'OPTIONS': {'directory': '/var/cache/documents', 'max_bytes': 2 ** 30},
+        }
+    """
+    global _cache, _config
+    config = getattr(settings, 'DOCUMENT_PDF_RESULT_CACHE', None)
+    if config is not _config:
+        _cache = import_string(config['BACKEND'])(**config.get('OPTIONS', {})) if config else None
+        _config = config
+    return _cache
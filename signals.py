@@ -0,0 +1,31 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal, receiver
+from .images import get_image_cache
+from .layout import invalidate_layout_plan
+from .models import (PDFFont, FontStyle, DocumentSpec, DocumentSpecFields, DocumentSpecLabels,
+                     DocumentSpecRects, DocumentSpecImages, DocumentSpecFonts)
+
+# Sent after each instrumented render with sender=the DocumentPDF class and the
+# `document` and its `stats` (an instrumentation.RenderStats) as arguments.
+document_rendered = Signal()
+
+
+@receiver([post_save, post_delete], sender=DocumentSpecFields, dispatch_uid='ddp_fields_changed')
+@receiver([post_save, post_delete], sender=DocumentSpecLabels, dispatch_uid='ddp_labels_changed')
+@receiver([post_save, post_delete], sender=DocumentSpecRects, dispatch_uid='ddp_rects_changed')
+@receiver([post_save, post_delete], sender=DocumentSpecImages, dispatch_uid='ddp_images_changed')
+@receiver([post_save, post_delete], sender=DocumentSpecFonts, dispatch_uid='ddp_fonts_changed')
+def spec_element_changed(sender, instance, **kwargs):
+    invalidate_layout_plan(instance.DocumentSpec.Code)
+    if sender is DocumentSpecImages:
+        # The file may have been replaced under the same name.
+        get_image_cache().clear()
+
+
+@receiver([post_save, post_delete], sender=DocumentSpec, dispatch_uid='ddp_spec_changed')
+@receiver([post_save, post_delete], sender=FontStyle, dispatch_uid='ddp_style_changed')
+@receiver([post_save, post_delete], sender=PDFFont, dispatch_uid='ddp_font_changed')
+def spec_shared_changed(sender, instance, **kwargs):
+    # The spec code itself may have been renamed and styles or fonts can be
+    # shared by many specs, so every compiled plan is dropped.
+    invalidate_layout_plan()
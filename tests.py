@@ -1,3 +1,872 @@
-from django.test import TestCase
+import asyncio
+import io
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import reportlab
+from unittest import skipUnless
+from PIL import Image
+from reportlab.lib import pagesizes
+from reportlab.lib.colors import black
+from reportlab.pdfgen import canvas
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.exceptions import PermissionDenied
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import models
+from django.test import RequestFactory, TestCase, override_settings
+from .async_render import RenderLimiter, RenderQueueFull, agenerate_pdf
+from .batch import render_batch
+from .bundles import dumps_bundle, export_specs, load_bundles, loads_bundle, msgpack
+from .document_wrapper import DocumentPDF
+from .fonts import register_font, registration_times
+from .images import ImageCache, get_image_cache
+from .instrumentation import PrometheusMetrics
+from .output_stats import _object_spans
+from . import layout
+from .layout import (SHARED_VERSION_KEY, get_layout_plan, invalidate_layout_plan, spec_version,
+                     unregister_spec_source)
+from .ops import BACKGROUND, FOREGROUND, execute_ops
+from .parallel import get_process_executor, pool_context, render_parallel
+from .relations import RelationCache, query_lookups, refetch_record, values_lookup
+from .result_cache import DiskResultCache
+from .signals import document_rendered
+from .text_utils import (latin1_to_ascii, latin1_to_ascii_many, string_width, wrapText,
+                         wrap_text_width)
+from .views import adocument_pdf, document_pdf
+from .models import (PDFFont, FontStyle, DocumentSpec, DocumentSpecFields,
+                     DocumentSpecLabels, DocumentSpecFonts, DocumentSpecRects,
+                     DocumentSpecImages)
 
-# Create your tests here.
+
+class DocumentSpecTestCase(TestCase):
+    """Runs inside a temp dir with the `media/fonts/Vera.ttf` shipped with reportlab."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._cwd = os.getcwd()
+        cls._tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(cls._tmpdir, 'media', 'fonts'))
+        shutil.copy(os.path.join(os.path.dirname(reportlab.__file__), 'fonts', 'Vera.ttf'),
+                    os.path.join(cls._tmpdir, 'media', 'fonts'))
+        os.chdir(cls._tmpdir)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls._cwd)
+        shutil.rmtree(cls._tmpdir)
+        super().tearDownClass()
+
+    def setUp(self):
+        invalidate_layout_plan()
+        self.font = PDFFont.objects.create(Code='Vera', Font='fonts/Vera.ttf')
+
+    def createSpec(self, code, fields=(), labels=(), **kwargs):
+        """Creates a spec where each field is a (path, type) pair, styles are shared per field."""
+        spec = DocumentSpec.objects.create(Code=code, Width=595, Height=842, **kwargs)
+        DocumentSpecFonts.objects.create(DocumentSpec=spec, PDFFont=self.font)
+        for idx, (path, ftype) in enumerate(fields):
+            style = FontStyle.objects.create(
+                Code=f'{code}{idx}', PDFFont=self.font, Color='#336699', Size=8 + idx % 4)
+            DocumentSpecFields.objects.create(
+                DocumentSpec=spec, Field=path, Style=style, Type=ftype, X=10, Y=20 + idx * 10)
+        for idx, text in enumerate(labels):
+            style = FontStyle.objects.create(Code=f'{code}L{idx}', PDFFont=self.font)
+            DocumentSpecLabels.objects.create(
+                DocumentSpec=spec, Text=text, Style=style, X=300, Y=20 + idx * 10, Alignment=0)
+        return spec
+
+
+class StyleQueriesTest(DocumentSpecTestCase):
+
+    def test_compile_queries_do_not_grow_with_fields(self):
+        self.createSpec('Small', fields=[('Code', 0)], labels=['A'])
+        self.createSpec('Large', fields=[('Code', 0)] * 20, labels=['A'] * 20)
+        with self.assertNumQueries(6):
+            get_layout_plan('Small')
+        with self.assertNumQueries(6):
+            get_layout_plan('Large')
+
+    def test_render_makes_no_style_queries(self):
+        spec = self.createSpec('Header', fields=[('Code', 0)] * 20, labels=['A'] * 20)
+        get_layout_plan('Header')
+        with self.assertNumQueries(0):
+            DocumentPDF('Header', os.path.join(self._tmpdir, 'out.pdf'), spec).generatePDF()
+
+
+class PaginationTest(DocumentSpecTestCase):
+
+    def test_pages_follow_detail_rows(self):
+        # The spec itself is the record, its fields are the detail rows.
+        spec = self.createSpec('Paged', fields=[('documentspecfields.Field', 1)] * 7,
+                               RowsPerPage=3)
+        doc = DocumentPDF('Paged', os.path.join(self._tmpdir, 'out.pdf'), spec)
+        self.assertEqual(doc.lastPageNr(), 3)
+        self.assertEqual(doc.generatePDF().getPageNumber() - 1, 3)
+
+    def test_single_page_without_rows_per_page(self):
+        spec = self.createSpec('Single', fields=[('documentspecfields.Field', 1)] * 7)
+        doc = DocumentPDF('Single', os.path.join(self._tmpdir, 'out.pdf'), spec)
+        self.assertEqual(doc.lastPageNr(), 1)
+
+
+class BatchTest(DocumentSpecTestCase):
+
+    def test_combined_batch_prefetches_details(self):
+        self.createSpec('Batch', fields=[('Code', 0), ('documentspecfields.Field', 1)],
+                        RowsPerPage=1)
+        output = os.path.join(self._tmpdir, 'batch.pdf')
+        get_layout_plan('Batch')
+        with self.assertNumQueries(2):
+            result = render_batch('Batch', DocumentSpec.objects.all(), output)
+        self.assertEqual(result.documents, 1)
+        self.assertEqual(result.outputs, [output])
+
+    def test_file_per_record(self):
+        spec = self.createSpec('Each', fields=[('Code', 0)])
+        result = render_batch('Each', [spec], os.path.join(self._tmpdir, '{pk}.pdf'),
+                              combine=False)
+        self.assertTrue(os.path.exists(result.outputs[0]))
+
+
+class ParallelTest(DocumentSpecTestCase):
+
+    def createRecords(self):
+        return [self.createSpec(f'Par{idx}', fields=[('Code', 0)]).pk for idx in range(5)]
+
+    def test_inline_keeps_input_order(self):
+        pks = self.createRecords()[::-1] + [0]
+        result = render_parallel('Par0', DocumentSpec, pks, workers=0, chunk_size=2)
+        self.assertEqual(result.documents, 5)
+        self.assertIsNone(result.outputs[-1])
+        self.assertTrue(all(pdf.startswith(b'%PDF') for pdf in result.outputs[:-1]))
+
+    @skipUnless('fork' in multiprocessing.get_all_start_methods(), "needs fork")
+    def test_process_pool_matches_inline(self):
+        pks = self.createRecords()
+        result = render_parallel('Par0', 'django_document_pdf.DocumentSpec', pks, workers=2,
+                                 chunk_size=2, mp_context=multiprocessing.get_context('fork'))
+        self.assertEqual(result.documents, 5)
+        self.assertEqual([len(pdf) > 0 for pdf in result.outputs], [True] * 5)
+
+    def test_workers_are_not_forked_by_default(self):
+        # Forked workers would share the database sockets of the caller.
+        self.assertNotEqual(pool_context().get_start_method(), 'fork')
+
+
+class StreamingTest(DocumentSpecTestCase):
+
+    def test_generate_without_filename_raises(self):
+        spec = self.createSpec('NoFile', fields=[('Code', 0)])
+        with self.assertRaisesMessage(ValueError, "no filename or buffer"):
+            DocumentPDF('NoFile', None, spec).generatePDF()
+        self.assertFalse(os.path.exists('None'))
+        self.assertTrue(DocumentPDF('NoFile', None, spec).getPDFData().startswith(b'%PDF'))
+
+    def test_targets_that_cant_be_measured(self):
+        spec = self.createSpec('Targets', fields=[('Code', 0)])
+
+        class WriteOnly:
+            def __init__(self):
+                self.data = b''
+
+            def write(self, data):
+                self.data += data
+
+        class Pipe(WriteOnly):
+            def tell(self):
+                raise OSError(29, "Illegal seek")
+
+        for target in (WriteOnly(), Pipe()):
+            reports = []
+            DocumentPDF('Targets', target, spec).generatePDF()
+            DocumentPDF('Targets', target, spec, instrument=reports.append).generatePDF()
+            self.assertTrue(target.data.startswith(b'%PDF'))
+            self.assertIsNone(reports[0].output_bytes)
+
+    def test_streamed_chunks_match_rendered_pdf(self):
+        spec = self.createSpec('Stream', fields=[('Code', 0)])
+        chunks = list(DocumentPDF('Stream', None, spec).streamPDF(chunk_size=512))
+        data = b''.join(chunks)
+        self.assertTrue(data.startswith(b'%PDF'))
+        self.assertTrue(all(len(chunk) <= 512 for chunk in chunks))
+
+    def test_view_requires_view_permission(self):
+        spec = self.createSpec('View', fields=[('Code', 0)])
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        with self.assertRaises(PermissionDenied):
+            document_pdf(request, 'View', 'django_document_pdf.DocumentSpec', spec.pk)
+        request.user = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        response = document_pdf(request, 'View', 'django_document_pdf.DocumentSpec', spec.pk)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+
+
+class FontRegistryTest(DocumentSpecTestCase):
+
+    def test_font_is_parsed_again_only_when_content_changes(self):
+        path = os.path.join(self._tmpdir, 'media', 'fonts', 'Copy.ttf')
+        shutil.copy(os.path.join('media', 'fonts', 'Vera.ttf'), path)
+        self.assertTrue(register_font('RegistryCopy', path))
+        self.assertIn('RegistryCopy', registration_times)
+        self.assertFalse(register_font('RegistryCopy', path))
+        shutil.copy(os.path.join(os.path.dirname(reportlab.__file__), 'fonts', 'VeraBd.ttf'), path)
+        self.assertTrue(register_font('RegistryCopy', path))
+
+
+class StaticLayerTest(DocumentSpecTestCase):
+
+    def test_labels_are_drawn_once_for_all_pages(self):
+        spec = self.createSpec('Static', fields=[('documentspecfields.Field', 1)] * 4,
+                               labels=['Static label'], RowsPerPage=1)
+        data = DocumentPDF('Static', None, spec).getPDFData()
+        self.assertEqual(data.count(b'/Type /Page\n'), 4)
+        self.assertEqual(data.count(b'/Subtype /Form'), 1)
+
+
+class ImageTest(DocumentSpecTestCase):
+
+    def setUp(self):
+        super().setUp()
+        get_image_cache().clear()
+        os.makedirs(os.path.join('media', 'images'), exist_ok=True)
+        Image.new('RGB', (40, 20), (200, 30, 30)).save(os.path.join('media', 'images', 'logo.png'))
+
+    def createImageSpec(self, code, filename='images/logo.png'):
+        spec = self.createSpec(code, fields=[('Code', 0), ('documentspecfields.Field', 1)],
+                               RowsPerPage=1)
+        DocumentSpecImages.objects.create(DocumentSpec=spec, X=10, Y=10, Width=80, Height=40,
+                                          Filename=filename)
+        return spec
+
+    def assertValidPDF(self, data):
+        # Every object of the cross-reference table is where it says.
+        for number, (start, _) in _object_spans(data).items():
+            self.assertTrue(data[start:].startswith(f'{number} 0 obj'.encode()))
+
+    def test_pages_share_one_embedded_image(self):
+        spec = self.createImageSpec('Logo')
+        data = DocumentPDF('Logo', None, spec).getPDFData()
+        self.assertEqual(data.count(b'/Type /Page\n'), 2)
+        self.assertEqual(data.count(b'/Subtype /Image'), 1)
+        self.assertValidPDF(data)
+
+    def test_next_document_reuses_the_encoded_image(self):
+        spec = self.createImageSpec('Logo')
+        first = DocumentPDF('Logo', None, spec).getPDFData()
+        item = get_image_cache().get('media/images/logo.png')
+        xobject = item.xobject
+        self.assertIsNotNone(xobject)
+        second = DocumentPDF('Logo', None, spec).getPDFData()
+        self.assertIs(item.xobject, xobject)
+        self.assertEqual(second.count(b'/Subtype /Image'), 1)
+        self.assertValidPDF(second)
+        self.assertEqual(len(second), len(first))
+
+    def test_missing_image_is_skipped_with_a_warning(self):
+        spec = self.createImageSpec('NoLogo', 'images/missing.png')
+        with self.assertLogs('django_document_pdf.images', 'WARNING') as logs:
+            data = DocumentPDF('NoLogo', None, spec).getPDFData()
+        self.assertIn('media/images/missing.png not available', logs.output[0])
+        self.assertNotIn(b'/Subtype /Image', data)
+
+    def test_cache_evicts_by_size(self):
+        paths = []
+        for idx in range(3):
+            paths.append(os.path.join('media', 'images', f'tile{idx}.png'))
+            Image.new('RGB', (10, 10)).save(paths[-1])
+        cache = ImageCache(max_bytes=700)
+        first, second = cache.get(paths[0]), cache.get(paths[1])
+        self.assertEqual(cache.size, 600)
+        cache.get(paths[0])  # Now the most recently used.
+        cache.get(paths[2])
+        self.assertEqual(cache.size, 600)
+        self.assertIs(cache.get(paths[0]), first)
+        self.assertIsNot(cache.get(paths[1]), second)
+
+
+class RelationCacheTest(DocumentSpecTestCase):
+
+    def test_records_do_not_share_detail_rows(self):
+        short = self.createSpec('Short', fields=[('documentspecfields.Field', 1)] * 2,
+                                RowsPerPage=1)
+        long = self.createSpec('Long', fields=[('documentspecfields.Field', 1)] * 5,
+                               RowsPerPage=1)
+        self.assertEqual(DocumentPDF('Short', None, short).lastPageNr(), 2)
+        self.assertEqual(DocumentPDF('Short', None, long).lastPageNr(), 5)
+
+    def test_bounded_cache_counts_hits_and_evicts(self):
+        first = self.createSpec('First', fields=[('Code', 0)])
+        second = self.createSpec('Second', fields=[('Code', 0)])
+        cache = RelationCache(max_size=1)
+        cache.rows(first, 'documentspecfields_set')
+        cache.rows(first, 'documentspecfields_set')
+        cache.rows(second, 'documentspecfields_set')
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 2, 1))
+        with self.assertNumQueries(1):
+            cache.rows(first, 'documentspecfields_set')
+
+
+class FieldAccessorTest(DocumentSpecTestCase):
+
+    def test_detail_columns_follow_foreign_keys(self):
+        spec = self.createSpec('Columns', fields=[('Code', 0), ('documentspecfields.Style.Code', 1)])
+        doc = DocumentPDF('Columns', None, spec)
+        dsfield = doc._Fields[1]
+        self.assertEqual(doc.detailValues(dsfield), ['Columns0', 'Columns1'])
+
+    def test_null_hop_blanks_only_its_row(self):
+        spec = self.createSpec('Hops', fields=[('Code', 0), ('documentspecfields.Width.real', 1),
+                                               ('documentspecfields.Style.Nope', 1)])
+        DocumentSpecFields.objects.filter(DocumentSpec=spec, Field='Code').update(Width=5)
+        doc = DocumentPDF('Hops', None, spec)
+        self.assertEqual(doc.detailValues(doc._Fields[1]), [5, '', ''])
+        # A path that no row can read stays empty, for the place holder.
+        self.assertEqual(doc.detailValues(doc._Fields[2]), [])
+        self.assertTrue(doc.getPDFData().startswith(b'%PDF'))
+
+    def test_strict_mode_reports_bad_paths(self):
+        spec = self.createSpec('Strict', fields=[('Code', 0), ('Nope', 0),
+                                                 ('documentspecfields.Style.Nope', 1),
+                                                 ('nothing.Code', 1)])
+        with self.assertRaisesMessage(ValueError, "Nope: DocumentSpec has no attribute 'Nope'"):
+            DocumentPDF('Strict', None, spec, strict=True)
+        with self.assertRaisesMessage(ValueError, "nothing.Code: DocumentSpec has no detail"):
+            DocumentPDF('Strict', None, spec, strict=True)
+        with self.assertRaisesMessage(ValueError, "FontStyle has no attribute 'Nope'"):
+            DocumentPDF('Strict', None, spec, strict=True)
+        doc = DocumentPDF('Strict', None, spec)
+        self.assertEqual(doc.headerValues(doc._Fields[1]), [])
+
+
+class QueryPlanTest(DocumentSpecTestCase):
+
+    def test_lookups_follow_field_paths(self):
+        self.createSpec('Lookups', fields=[('Code', 0), ('documentspecfields.Style.PDFFont.Code', 1),
+                                           ('documentspecfields.Field', 1)])
+        plan = get_layout_plan('Lookups')
+        self.assertEqual(query_lookups(plan, DocumentSpec), (
+            (), (('documentspecfields_set', DocumentSpecFields, ('Style__PDFFont',)),)))
+        self.assertEqual(query_lookups(plan, DocumentSpecFields), ((), ()))
+
+    def test_refetched_record_renders_in_constant_queries(self):
+        for code, rows in (('Short', 3), ('Long', 30)):
+            self.createSpec(code, fields=[('documentspecfields.Style.PDFFont.Code', 1)] * rows,
+                            RowsPerPage=10)
+            spec = DocumentSpec.objects.get(Code=code)
+            get_layout_plan(code)
+            with self.assertNumQueries(2):
+                record = refetch_record(code, spec)
+                DocumentPDF(code, os.path.join(self._tmpdir, 'out.pdf'), record).generatePDF()
+
+
+class TextWrapTest(DocumentSpecTestCase):
+
+    def test_lines_fit_the_field_width(self):
+        register_font('Vera', 'media/fonts/Vera.ttf')
+        text = "Stainless steel screw M4 x 20 mm, box of 100 units\nSecond line"
+        lines = wrap_text_width(text, 'Vera', 9, 80)
+        self.assertGreater(len(lines), 2)
+        self.assertEqual(" ".join(lines).split(), text.split())
+        for line in lines:
+            self.assertLessEqual(string_width(line, 'Vera', 9), 80)
+        self.assertEqual(wrap_text_width("Supercalifragilistic x", 'Vera', 9, 20),
+                         ["Supercalifragilistic", "x"])
+
+    def test_char_count_wrapping_is_unchanged(self):
+        self.assertEqual(wrapText("short", 10), ["short"])
+        self.assertEqual(wrapText("one two three four\nfive", 8),
+                         ["one two ", "three ", "four ", "five"])
+
+
+def reference_latin1_to_ascii(unicrap):
+    """The character by character implementation latin1_to_ascii replaced."""
+    xlate = {0xc0: 'A', 0xc1: 'A', 0xc2: 'A', 0xc3: 'A', 0xc4: 'A', 0xc5: 'A',
+             0xc6: 'Ae', 0xc7: 'C',
+             0xc8: 'E', 0xc9: 'E', 0xca: 'E', 0xcb: 'E',
+             0xcc: 'I', 0xcd: 'I', 0xce: 'I', 0xcf: 'I',
+             0xd0: 'Th', 0xd1: 'N',
+             0xd2: 'O', 0xd3: 'O', 0xd4: 'O', 0xd5: 'O', 0xd6: 'O', 0xd8: 'O',
+             0xd9: 'U', 0xda: 'U', 0xdb: 'U', 0xdc: 'U',
+             0xdd: 'Y', 0xde: 'th', 0xdf: 'ss',
+             0xe0: 'a', 0xe1: 'a', 0xe2: 'a', 0xe3: 'a', 0xe4: 'a', 0xe5: 'a',
+             0xe6: 'ae', 0xe7: 'c',
+             0xe8: 'e', 0xe9: 'e', 0xea: 'e', 0xeb: 'e',
+             0xec: 'i', 0xed: 'i', 0xee: 'i', 0xef: 'i',
+             0xf0: 'th', 0xf1: 'n',
+             0xf2: 'o', 0xf3: 'o', 0xf4: 'o', 0xf5: 'o', 0xf6: 'o', 0xf8: 'o',
+             0xf9: 'u', 0xfa: 'u', 0xfb: 'u', 0xfc: 'u',
+             0xfd: 'y', 0xfe: 'th', 0xff: 'y',
+             0xa1: '!', 0xa2: '{cent}', 0xa3: '{pound}',
+             0xa5: '{yen}', 0xa6: '|', 0xa7: '{section}', 0xa8: '{umlaut}',
+             0xa9: '{C}', 0xaa: '^a', 0xab: '<<',
+             0xad: '-', 0xaf: '_',
+             0xb1: '+/-', 0xb2: '^2', 0xb3: '^3', 0xb4: "'",
+             0xb5: '{micro}', 0xb6: '{paragraph}', 0xb7: '*', 0xb8: '{cedilla}',
+             0xbb: '>>',
+             0xbc: '1/4', 0xbd: '1/2', 0xbe: '3/4', 0xbf: '?',
+             0xd7: '*', 0xf7: '/'
+             }
+    r = ''
+    for i in unicrap:
+        if ord(i) in xlate:
+            r += xlate[ord(i)]
+        elif ord(i) >= 0x80:
+            pass
+        else:
+            r += i
+    return r
+
+
+class TransliterationTest(TestCase):
+
+    def test_matches_reference_over_latin1(self):
+        for code in range(0x100):
+            self.assertEqual(latin1_to_ascii(chr(code)), reference_latin1_to_ascii(chr(code)),
+                             hex(code))
+        text = "".join(map(chr, range(0x100))) + " Ωmega €uro Año Ñandú"
+        self.assertEqual(latin1_to_ascii(text), reference_latin1_to_ascii(text))
+
+    def test_column_is_transliterated_at_once(self):
+        values = ["Año", 12, "Ñandú\0x", "", "€"]
+        self.assertEqual(latin1_to_ascii_many(values),
+                         [reference_latin1_to_ascii("%s" % value) for value in values])
+        self.assertEqual(latin1_to_ascii_many(values[:2]), ["Ano", "12"])
+        self.assertEqual(latin1_to_ascii_many([]), [])
+
+
+class InstrumentationTest(DocumentSpecTestCase):
+
+    def test_callback_receives_phases_queries_and_size(self):
+        spec = self.createSpec('Measured', fields=[('Code', 0), ('documentspecfields.Field', 1)],
+                               labels=['A', 'B'], RowsPerPage=1)
+        reports = []
+        data = DocumentPDF('Measured', None, spec, instrument=reports.append).getPDFData()
+        stats, = reports
+        self.assertEqual(stats.spec_code, 'Measured')
+        self.assertEqual(stats.pages, 2)
+        self.assertEqual(stats.output_bytes, len(data))
+        # The plan is compiled in spec_load, the detail rows are read in data.
+        self.assertEqual(stats.phase_queries['spec_load'], 6)
+        self.assertEqual(stats.phase_queries['data'], 1)
+        self.assertEqual(stats.queries, 7)
+        # 2 labels once per canvas, the header on 2 pages and 2 detail rows.
+        self.assertEqual(stats.draw_calls, 6)
+        self.assertGreater(stats.phases['fields'], 0)
+        self.assertGreater(stats.phases['save'], 0)
+
+    def test_signal_feeds_prometheus_metrics(self):
+        spec = self.createSpec('Exposed', fields=[('Code', 0)])
+        metrics = PrometheusMetrics()
+        document_rendered.connect(metrics.receiver)
+        try:
+            DocumentPDF('Exposed', os.path.join(self._tmpdir, 'out.pdf'), spec).generatePDF()
+        finally:
+            document_rendered.disconnect(metrics.receiver)
+        text = metrics.expose()
+        self.assertIn('document_pdf_documents_total{spec="Exposed"} 1\n', text)
+        self.assertIn('# TYPE document_pdf_render_seconds histogram', text)
+        self.assertIn('document_pdf_render_seconds_bucket{spec="Exposed",le="+Inf"} 1\n', text)
+        self.assertIn('document_pdf_phase_seconds_count{spec="Exposed",phase="save"} 1\n', text)
+
+
+class SubjectDocumentPDF(DocumentPDF):
+    # Module level, so the workers of a process pool can unpickle it.
+
+    def createCanvas(self, filename, pagesize=pagesizes.A4):
+        curCanvas = super().createCanvas(filename, pagesize)
+        curCanvas.setSubject("Rendered by SubjectDocumentPDF")
+        return curCanvas
+
+
+class AsyncRenderTest(DocumentSpecTestCase):
+
+    async def test_async_view_streams_the_document(self):
+        spec = await sync_to_async(self.createSpec)(
+            'Async', fields=[('Code', 0), ('documentspecfields.Style.Code', 1)])
+        user = await User.objects.acreate(username='async', is_superuser=True)
+        request = RequestFactory().get('/')
+        request.user = user
+        response = await adocument_pdf(request, 'Async', 'django_document_pdf.DocumentSpec',
+                                       spec.pk)
+        data = b"".join([bytes(chunk) async for chunk in response.streaming_content])
+        self.assertTrue(data.startswith(b'%PDF'))
+        self.assertEqual(data.count(b'/Type /Page\n'), 1)
+
+    @skipUnless('fork' in multiprocessing.get_all_start_methods(), "needs fork")
+    def test_process_pool_renders_in_a_worker(self):
+        spec = self.createSpec('Pooled', fields=[('Code', 0)])
+        render = async_to_sync(agenerate_pdf)
+        with get_process_executor('Pooled', 1, 'fork') as executor:
+            # Forked from this thread, the in-memory test database is only seen
+            # through its connection.
+            executor.submit(os.getpid).result()
+            data = render('Pooled', DocumentSpec, spec.pk, executor=executor,
+                          document_class=SubjectDocumentPDF)
+            with self.assertRaises(DocumentSpec.DoesNotExist):
+                render('Pooled', DocumentSpec, 0, executor=executor)
+        self.assertIn(b'(Rendered by SubjectDocumentPDF)', data)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            with self.assertRaisesMessage(ValueError, "get_process_executor"):
+                render('Pooled', DocumentSpec, spec.pk, executor=executor)
+
+    async def test_renders_beyond_the_queue_are_rejected(self):
+        limiter = RenderLimiter(max_concurrent=1, max_waiting=1)
+        async with limiter:
+            waiting = asyncio.ensure_future(limiter.__aenter__())
+            await asyncio.sleep(0)
+            with self.assertRaises(RenderQueueFull):
+                await agenerate_pdf('Missing', DocumentSpec, 1, limiter=limiter)
+        await waiting
+        await limiter.__aexit__(None, None, None)
+        self.assertEqual((limiter.running, limiter.waiting), (0, 0))
+
+
+class ResultCacheTest(DocumentSpecTestCase):
+
+    def test_unchanged_documents_are_served_from_the_cache(self):
+        spec = self.createSpec('Cached', fields=[('ScreenDpi', 0), ('documentspecfields.Field', 1)])
+        cache = DiskResultCache(os.path.join(self._tmpdir, 'cache'))
+        reports = []
+
+        def render():
+            return DocumentPDF('Cached', None, spec, instrument=reports.append,
+                               result_cache=cache).getPDFData()
+
+        first = render()
+        self.assertEqual(render(), first)
+        self.assertEqual(len(reports), 1)
+        # Another value extracted from the record is another document.
+        spec.ScreenDpi = 72
+        self.assertNotEqual(render(), first)
+        self.assertEqual(len(reports), 2)
+
+    def test_invariant_renders_are_byte_identical(self):
+        spec = self.createSpec('Invariant', fields=[('Code', 0)], labels=['A'])
+        data = [DocumentPDF('Invariant', None, spec, result_cache=DiskResultCache(
+            os.path.join(self._tmpdir, f'cache{idx}'))).getPDFData() for idx in range(2)]
+        self.assertEqual(data[0], data[1])
+
+    def test_disk_cache_evicts_least_recently_used(self):
+        cache = DiskResultCache(os.path.join(self._tmpdir, 'lru'), max_bytes=250)
+        cache.set('a', b'a' * 100)
+        cache.set('b', b'b' * 100)
+        os.utime(cache._path('a'), ns=(1, 1))
+        os.utime(cache._path('b'), ns=(2, 2))
+        self.assertEqual(cache.get('a'), b'a' * 100)
+        cache.set('c', b'c' * 100)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'a' * 100)
+        self.assertEqual(cache.get('c'), b'c' * 100)
+
+
+class StyleStateTest(DocumentSpecTestCase):
+
+    def test_unchanged_style_is_set_once(self):
+        spec = self.createSpec('State', fields=[('Code', 0)] * 10)
+        style = FontStyle.objects.get(Code='State0')
+        DocumentSpecFields.objects.filter(DocumentSpec=spec).update(Style=style)
+        curCanvas = canvas.Canvas(None, pageCompression=0)
+        DocumentPDF('State', None, spec).generatePDF(curCanvas=curCanvas)
+        data = curCanvas.getpdfdata()
+        # 10 values drawn in one text object with a single fill color operator.
+        self.assertEqual(data.count(b' Tj '), 10)
+        self.assertEqual(data.count(b'.2 .4 .6 rg'), 1)
+        self.assertEqual(data.count(b' Tm '), 10)
+        self.assertEqual(data.count(b' Tj T* ET'), 1)
+
+
+class RenderDocumentsCommandTest(DocumentSpecTestCase):
+
+    def test_checkpoint_resumes_the_run(self):
+        specs = [self.createSpec(f'Cmd{idx}', fields=[('Code', 0)]) for idx in range(3)]
+        output = os.path.join(self._tmpdir, 'cmd_{pk}.pdf')
+        checkpoint = os.path.join(self._tmpdir, 'cmd.checkpoint')
+        # A primary key of another selection is in the checkpoint too.
+        with open(checkpoint, 'w') as f:
+            f.write(f"{specs[0].pk}\n999999\n")
+        stdout = io.StringIO()
+        call_command('render_documents', 'Cmd0', 'django_document_pdf.DocumentSpec',
+                     '--filter', 'Code__startswith=Cmd', '--output', output, '--chunk-size', '2',
+                     '--checkpoint', checkpoint, stdout=stdout)
+        self.assertIn("Skipping 1 documents", stdout.getvalue())
+        self.assertIn("2/2 documents", stdout.getvalue())
+        self.assertFalse(os.path.exists(output.format(pk=specs[0].pk)))
+        for spec in specs[1:]:
+            self.assertTrue(os.path.exists(output.format(pk=spec.pk)))
+        with open(checkpoint) as f:
+            self.assertEqual(f.read().split(),
+                             [str(specs[0].pk), '999999'] + [str(spec.pk) for spec in specs[1:]])
+        stdout = io.StringIO()
+        call_command('render_documents', 'Cmd0', 'django_document_pdf.DocumentSpec',
+                     '--filter', 'Code__startswith=Cmd', '--output', output,
+                     '--checkpoint', checkpoint, stdout=stdout)
+        self.assertIn("Rendered 0 documents", stdout.getvalue())
+
+    def test_combined_pks_file(self):
+        specs = [self.createSpec(f'Comb{idx}', fields=[('Code', 0)], PageCompression=False)
+                 for idx in range(3)]
+        pks_file = os.path.join(self._tmpdir, 'pks.txt')
+        with open(pks_file, 'w') as f:
+            f.write(f"{specs[2].pk}\n{specs[0].pk}\n")
+        output = os.path.join(self._tmpdir, 'combined.pdf')
+        call_command('render_documents', 'Comb0', 'django_document_pdf.DocumentSpec',
+                     '--pks-file', pks_file, '--output', output, '--combine', stdout=io.StringIO())
+        with open(output, 'rb') as f:
+            data = f.read()
+        self.assertEqual(data.count(b'/Type /Page\n'), 2)
+        # The pages follow the file, not the primary keys.
+        self.assertLess(data.index(b'(Comb2) Tj'), data.index(b'(Comb0) Tj'))
+
+
+class DrawOpsTest(DocumentSpecTestCase):
+
+    def test_ops_are_comparable_and_picklable(self):
+        spec = self.createSpec('Ops', fields=[('Code', 0), ('documentspecfields.Field', 1)],
+                               labels=['Total'], RowsPerPage=1)
+        ops = DocumentPDF('Ops', None, spec).buildOps()
+        page = [('static', BACKGROUND), ('fill_color', black, 1), ('fill_rgb', .2, .4, .6),
+                ('font', 'Vera', 8), ('text', 10, 814, 'Ops'), ('font', 'Vera', 9)]
+        self.assertEqual(list(ops), page + [('text', 10, 803, 'Code'), ('static', FOREGROUND),
+                                            ('page',)] +
+                         page + [('text', 10, 803, 'documentspecfields.Field'),
+                                 ('static', FOREGROUND), ('page',)])
+        self.assertEqual(ops.draw_calls, 4)
+        copy = pickle.loads(pickle.dumps(ops))
+        self.assertEqual(copy, ops)
+        curCanvas = canvas.Canvas(None, pageCompression=0)
+        execute_ops(copy, curCanvas)
+        self.assertEqual(curCanvas.getPageNumber() - 1, 2)
+        # The labels come with the ops, drawn once in a form stamped on both pages.
+        data = curCanvas.getpdfdata()
+        self.assertEqual(data.count(b'(Total) Tj'), 1)
+        self.assertEqual(data.count(b'/FormXob.ddplayer0 Do'), 2)
+        copy.layers = None
+        with self.assertRaisesMessage(ValueError, "STATIC ops need the forms"):
+            execute_ops(copy, canvas.Canvas(None))
+
+
+class LedgerLine(models.Model):
+    """Detail rows of a font with an optional style, a table of the tests only."""
+    Font = models.ForeignKey(PDFFont, on_delete=models.CASCADE)
+    Style = models.ForeignKey(FontStyle, null=True, blank=True, on_delete=models.SET_NULL)
+
+    no_admin = True
+
+    class Meta:
+        app_label = 'django_document_pdf'
+
+
+class StreamingDetailTest(DocumentSpecTestCase):
+    """The font is the record, its styles are the detail rows."""
+
+    def createRows(self, rows):
+        FontStyle.objects.filter(Code__startswith='row').delete()
+        FontStyle.objects.bulk_create(FontStyle(Code=f'row{idx}', PDFFont=self.font, Size=idx)
+                                      for idx in range(rows))
+
+    def renderMemory(self, rows, streaming):
+        self.createRows(rows)
+        curCanvas = canvas.Canvas(None)
+        tracemalloc.start()
+        try:
+            DocumentPDF('Ledger', None, self.font, streaming=streaming).generatePDF(
+                curCanvas=curCanvas)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # Memory of the render beyond the pages kept by the canvas until it is saved.
+        return peak - current
+
+    def test_streamed_document_matches(self):
+        self.createRows(120)
+        styles = list(FontStyle.objects.filter(Code__startswith='row'))
+        LedgerLine.objects.bulk_create(LedgerLine(Font=self.font, Style=style if idx % 3 else None)
+                                       for idx, style in enumerate(styles))
+        # A line without style must be blank in both, values_list would give None.
+        self.assertIsNone(values_lookup(LedgerLine, 'Style.Code'))
+        # pk isn't a model field, the rows are then read as instances.
+        for code, paths in (('Values', ['fontstyle.Code', 'fontstyle.PDFFont.Code']),
+                            ('Instances', ['fontstyle.Code', 'fontstyle.pk']),
+                            ('NullHop', ['ledgerline.Font.Code', 'ledgerline.Style.Code'])):
+            with self.subTest(code):
+                self.createSpec(code, fields=[(path, 1) for path in paths], RowsPerPage=50)
+                data = []
+                for streaming in (False, True):
+                    curCanvas = canvas.Canvas(None, invariant=1)
+                    DocumentPDF(code, None, self.font, streaming=streaming).generatePDF(
+                        curCanvas=curCanvas)
+                    data.append(curCanvas.getpdfdata())
+                self.assertEqual(data[0], data[1])
+
+    def test_memory_follows_rows_per_page(self):
+        self.createSpec('Ledger', fields=[('fontstyle.Code', 1), ('fontstyle.Size', 1)],
+                        RowsPerPage=50)
+        self.renderMemory(10, True)
+        self.assertGreater(self.renderMemory(2000, False), 3 * self.renderMemory(500, False))
+        self.assertLess(self.renderMemory(2000, True), 1.5 * self.renderMemory(500, True))
+
+
+class SpecBundleTest(DocumentSpecTestCase):
+
+    def createBundledSpec(self):
+        spec = self.createSpec('Bundled', fields=[('Code', 0), ('documentspecfields.Field', 1)],
+                               labels=['Total'], RowsPerPage=2)
+        DocumentSpecRects.objects.create(DocumentSpec=spec, X=5, Y=5, Width=100, Height=50,
+                                         Rounded=True, Radius=3, Fill=True, FillColor='blue')
+        DocumentSpecImages.objects.create(DocumentSpec=spec, X=300, Y=100, Width=100, Height=50,
+                                          Filename='images/logo.png', Watermark=True,
+                                          WatermarkOpacity='0.3')
+        return spec
+
+    def test_bundled_spec_compiles_without_queries(self):
+        self.createBundledSpec()
+        fingerprint = get_layout_plan('Bundled').fingerprint
+        path = os.path.join(self._tmpdir, 'specs', 'bundled.json')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        call_command('export_specs', 'Bundled', output=path, stdout=io.StringIO())
+        self.addCleanup(unregister_spec_source)
+        self.assertEqual(load_bundles([os.path.dirname(path)]), ['Bundled'])
+        with self.assertNumQueries(0):
+            plan = get_layout_plan('Bundled')
+        self.assertEqual(plan.fingerprint, fingerprint)
+
+    def test_import_replaces_the_spec(self):
+        spec = self.createBundledSpec()
+        bundle = export_specs(['Bundled'])
+        path = os.path.join(self._tmpdir, 'bundled.json')
+        call_command('export_specs', output=path, stdout=io.StringIO())
+        DocumentSpecLabels.objects.filter(DocumentSpec=spec).delete()
+        DocumentSpecFields.objects.filter(DocumentSpec=spec).update(X=99)
+        call_command('import_specs', path, stdout=io.StringIO())
+        self.assertEqual(export_specs(['Bundled']), bundle)
+
+    @skipUnless(msgpack, "msgpack is not installed")
+    def test_msgpack_round_trip(self):
+        self.createBundledSpec()
+        bundle = export_specs()
+        data = dumps_bundle(bundle, 'msgpack')
+        self.assertEqual(loads_bundle(data, 'msgpack'), bundle)
+        self.assertLess(len(data), len(dumps_bundle(bundle)))
+
+
+class OutputOptionsTest(DocumentSpecTestCase):
+
+    def test_breakdown_adds_up_to_the_output(self):
+        spec = self.createSpec('Sized', fields=[('Code', 0), ('documentspecfields.Field', 1)],
+                               labels=['Total'], OutputStats=True, PageCompression=False)
+        reports = []
+        data = DocumentPDF('Sized', None, spec, instrument=reports.append).getPDFData()
+        breakdown = reports[0].output_breakdown
+        self.assertEqual(sum(breakdown[part] for part in ('fonts', 'images', 'content', 'other')),
+                         len(data))
+        self.assertEqual(breakdown['images'], 0)
+        vera = breakdown['embedded_fonts']['BitstreamVeraSans-Roman']
+        self.assertEqual(vera['subsets'], 1)
+        self.assertGreater(vera['glyphs'], 0)
+        self.assertLessEqual(vera['bytes'], breakdown['fonts'])
+        DocumentSpec.objects.filter(pk=spec.pk).update(PageCompression=True)
+        invalidate_layout_plan()
+        self.assertLess(len(DocumentPDF('Sized', None, spec).getPDFData()), len(data))
+
+    def test_combined_batch_over_an_old_output(self):
+        spec = self.createSpec('Combined', fields=[('Code', 0)], OutputStats=True)
+        path = os.path.join(self._tmpdir, 'combined.pdf')
+        with open(path, 'wb') as f:
+            f.write(b'%PDF-1.4 output of the last run')
+        reports = []
+
+        def receiver(sender, stats, **kwargs):
+            reports.append(stats)
+
+        document_rendered.connect(receiver)
+        try:
+            render_batch('Combined', [spec, spec], path)
+        finally:
+            document_rendered.disconnect(receiver)
+        # The documents are drawn on a canvas saved by the batch, they have no output.
+        self.assertEqual([stats.output_breakdown for stats in reports], [None, None])
+        with open(path, 'rb') as f:
+            self.assertTrue(f.read().startswith(b'%PDF'))
+
+    def test_over_budget_warns_with_the_breakdown(self):
+        spec = self.createSpec('Budget', fields=[('Code', 0)], SizeBudget=1)
+        path = os.path.join(self._tmpdir, 'budget.pdf')
+        with self.assertLogs('django_document_pdf.document_wrapper', 'WARNING') as logs:
+            DocumentPDF('Budget', path, spec).generatePDF()
+        message, = logs.output
+        self.assertIn(f"is {os.path.getsize(path)} bytes, over its budget of 1 bytes", message)
+        self.assertIn("'fonts'", message)
+
+
+class PlanVersionTest(DocumentSpecTestCase):
+
+    def test_saving_or_deleting_spec_rows_recompiles_the_plan(self):
+        self.createSpec('Signals', fields=[('Code', 0), ('Width', 0)])
+        plan = get_layout_plan('Signals')
+        self.assertIs(get_layout_plan('Signals'), plan)
+
+        field = DocumentSpecFields.objects.get(DocumentSpec__Code='Signals', Field='Code')
+        field.X = 200
+        field.save()
+        recompiled = get_layout_plan('Signals')
+        self.assertIsNot(recompiled, plan)
+        self.assertEqual(recompiled.fields[0].x, 200)
+
+        DocumentSpecFields.objects.get(DocumentSpec__Code='Signals', Field='Width').delete()
+        self.assertEqual([f.field for f in get_layout_plan('Signals').fields], ['Code'])
+
+        style = field.Style
+        style.Size = 20
+        style.save()
+        self.assertEqual(get_layout_plan('Signals').fields[0].style.size, 20)
+
+        plan = get_layout_plan('Signals')
+        self.font.save()
+        self.assertIsNot(get_layout_plan('Signals'), plan)
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                'plans': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                          'LOCATION': 'plan-versions'}},
+        DOCUMENT_PDF_PLAN_VERSION_CACHE='plans', DOCUMENT_PDF_PLAN_VERSION_TTL=0)
+    def test_change_saved_by_another_process_recompiles_the_plan(self):
+        spec = self.createSpec('Shared', fields=[('Code', 0)])
+        plan = get_layout_plan('Shared')
+        self.assertIs(get_layout_plan('Shared'), plan)
+        # Another process saved the field, here only the shared stamp changes.
+        DocumentSpecFields.objects.filter(DocumentSpec=spec).update(X=200)
+        caches['plans'].set(f'{SHARED_VERSION_KEY}:Shared', 'other', None)
+        recompiled = get_layout_plan('Shared')
+        self.assertIsNot(recompiled, plan)
+        self.assertNotEqual(recompiled.fingerprint, plan.fingerprint)
+        self.assertNotEqual(recompiled.fields[0].x, plan.fields[0].x)
+
+        for idx in range(3):
+            caches['plans'].set(f'{SHARED_VERSION_KEY}:Shared', f'edit{idx}', None)
+            get_layout_plan('Shared')
+        self.assertEqual([key for key in layout._plans if key[0] == 'Shared'],
+                         [('Shared', spec_version('Shared'))])
+
+    def test_plan_invalidated_while_compiling_is_not_kept(self):
+        spec = self.createSpec('Racing', fields=[('Code', 0)])
+        compile_plan = layout.compile_layout_plan
+
+        def compile_and_save(code, version):
+            plan = compile_plan(code, version)
+            DocumentSpecFields.objects.filter(DocumentSpec=spec).first().save()
+            return plan
+
+        layout.compile_layout_plan = compile_and_save
+        try:
+            get_layout_plan('Racing')
+        finally:
+            layout.compile_layout_plan = compile_plan
+        self.assertNotIn('Racing', [key[0] for key in layout._plans])
@@ -0,0 +1,11 @@
+from django.urls import path
+from . import views
+
+app_name = 'django_document_pdf'
+
+urlpatterns = [
+    path('<str:document_spec_code>/<str:model>/<str:pk>/', views.document_pdf,
+         name='document_pdf'),
+    path('async/<str:document_spec_code>/<str:model>/<str:pk>/', views.adocument_pdf,
+         name='adocument_pdf'),
+]
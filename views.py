@@ -1,3 +1,61 @@
-from django.shortcuts import render
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from .async_render import RenderQueueFull, agenerate_pdf, astream_pdf
+from .document_wrapper import DocumentPDF
+from .layout import get_layout_plan
+from .models import DocumentSpec
+from .relations import prepare_queryset
 
-# Create your views here.
+
+def get_model_or_404(request, model):
+    """Returns the model of "app_label.ModelName", the user needs its view permission."""
+    try:
+        model_class = apps.get_model(model)
+    except (LookupError, ValueError):
+        raise Http404(f"Model {model} not found")
+    opts = model_class._meta
+    if not request.user.has_perm(f'{opts.app_label}.view_{opts.model_name}'):
+        raise PermissionDenied
+    return model_class
+
+
+def document_pdf(request, document_spec_code, model, pk):
+    """Streams the PDF of the record `pk` of `model` ("app_label.ModelName").
+
+    The user needs the view permission of the model.
+    """
+    model_class = get_model_or_404(request, model)
+    try:
+        plan = get_layout_plan(document_spec_code)
+    except DocumentSpec.DoesNotExist:
+        raise Http404(f"Document Spec {document_spec_code} not found")
+    record = get_object_or_404(prepare_queryset(plan, model_class._default_manager.all()), pk=pk)
+    doc = DocumentPDF(document_spec_code, None, record)
+    response = StreamingHttpResponse(doc.streamPDF(), content_type='application/pdf')
+    response['Content-Disposition'] = f'inline; filename="{document_spec_code}_{pk}.pdf"'
+    return response
+
+
+async def adocument_pdf(request, document_spec_code, model, pk):
+    """Async version of document_pdf for ASGI servers, see agenerate_pdf.
+
+    Answers 503 with Retry-After when too many documents are waiting to be rendered.
+    """
+    model_class = await sync_to_async(get_model_or_404)(request, model)
+    try:
+        pdf = await agenerate_pdf(document_spec_code, model_class, pk)
+    except DocumentSpec.DoesNotExist:
+        raise Http404(f"Document Spec {document_spec_code} not found")
+    except model_class.DoesNotExist:
+        raise Http404(f"{model} {pk} not found")
+    except RenderQueueFull:
+        response = HttpResponse("Too many documents are being rendered, retry later.",
+                                status=503, content_type='text/plain')
+        response['Retry-After'] = '5'
+        return response
+    response = StreamingHttpResponse(astream_pdf(pdf), content_type='application/pdf')
+    response['Content-Disposition'] = f'inline; filename="{document_spec_code}_{pk}.pdf"'
+    return response